@@ -3,10 +3,22 @@
 import wx
 import sys, os
 import tempfile
+import shutil
+import gzip
+import tarfile
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl
+except ImportError:
+    # no reflinks (eg windows), plain copies are used
+    fcntl = None
 sys.path.insert(0, '/home/jagust/cindeem/CODE/ruffus')
 import MultiDirDialog as mdd
 from glob import glob
 import nibabel as ni
+from fileio import atomic_write
 import nipype
 from nipype.interfaces.base import CommandLine
 from nipype.interfaces.fsl import Split as fsl_split
@@ -229,45 +241,110 @@ def make_rec_dir(base_dir, dirname='fdg_nifti'):
 
 
 
-def remove_files(files):
-    """removes files """
+# ioctl request to clone (reflink) a file on btrfs/xfs
+FICLONE = 0x40049409
+
+def _pool_map(func, items, nthreads=8):
+    """ maps func over items in a thread pool, file copies and
+    gzip release the GIL so this runs them in parallel"""
+    items = list(items)
+    if len(items) < 2 or nthreads < 2:
+        return [func(x) for x in items]
+    pool = ThreadPool(max(1, min(nthreads, len(items))))
+    try:
+        result = pool.map(func, items)
+    finally:
+        pool.close()
+    return result
+
+def _reflink(infile, newfile):
+    """ tries to make newfile a copy-on-write clone of infile,
+    returns True on success"""
+    if fcntl is None:
+        return False
+    src = open(infile, 'rb')
+    try:
+        dst = open(newfile, 'wb')
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except (IOError, OSError):
+            dst.close()
+            os.remove(newfile)
+            return False
+        dst.close()
+    finally:
+        src.close()
+    shutil.copymode(infile, newfile)
+    return True
+
+def same_filesystem(infile, newdir):
+    """ checks if infile and newdir are on the same device"""
+    return os.stat(infile).st_dev == os.stat(newdir).st_dev
+
+def remove_file(infile):
+    """ removes one file, returns True on success"""
+    try:
+        os.remove(infile)
+    except OSError as e:
+        print 'failed to delete %s' % infile
+        print e
+        return False
+    return True
+
+def remove_files(files, nthreads=8):
+    """removes files (a file, a glob pattern or list of files) """
     if not hasattr(files, '__iter__'):
-        cl = CommandLine('rm %s'% files)
-        out = cl.run()
-        if not out.runtime.returncode == 0:
-            print 'failed to delete %s' % files
-            print out.runtime.stderr
-        return
-    for f in files:
-        cl = CommandLine('rm %s'% f)
-        out = cl.run()
-        if not out.runtime.returncode == 0:
-            print 'failed to delete %s' % f
-            print out.runtime.stderr
-    
-def copy_files(infiles, newdir):
+        if glob_pattern(files):
+            files = glob(files)
+        else:
+            files = [files]
+    _pool_map(remove_file, files, nthreads)
+
+def glob_pattern(item):
+    """ checks if item has shell wildcards"""
+    return any([x in item for x in '*?['])
+
+def copy_files(infiles, newdir, link=False, nthreads=8):
     """wraps copy file to run across multiple files
-    returns list"""
-    newfiles = []
-    for f in infiles:
-        newf = copy_file(f, newdir)
-        newfiles.append(newf)
-    return newfiles
+    (in a pool of threads) returns list"""
+    return _pool_map(lambda f: copy_file(f, newdir, link=link),
+                     infiles, nthreads)
 
-def copy_file(infile, newdir):
+def copy_file(infile, newdir, link=False):
     """ copy infile to new directory
     return full path of new file
+
+    on the same filesystem a reflink (copy-on-write clone) is used
+    when supported, if link is True a hardlink is used instead
+    (only for files that will not be modified in place)
     """
-    cl = CommandLine('cp %s %s'%(infile, newdir))
-    out = cl.run()
-    if not out.runtime.returncode == 0:
+    basenme = os.path.split(infile)[1]
+    if os.path.isdir(newdir):
+        newfile = os.path.join(newdir, basenme)
+        destdir = newdir
+    else:
+        newfile = newdir
+        destdir = os.path.split(os.path.abspath(newdir))[0]
+    try:
+        if os.path.isdir(infile):
+            raise IOError('%s is a directory'%(infile))
+        if os.path.abspath(infile) == os.path.abspath(newfile):
+            raise IOError('%s and %s are the same file'%(infile, newfile))
+        if os.path.lexists(newfile):
+            # never write through an existing (possibly hard) link
+            os.remove(newfile)
+        if same_filesystem(infile, destdir):
+            if link:
+                os.link(infile, newfile)
+                return newfile
+            if _reflink(infile, newfile):
+                return newfile
+        shutil.copy(infile, newfile)
+    except (IOError, OSError) as e:
         print 'failed to copy %s' % infile
-        print out.runtime.stderr
+        print e
         return None
-    else:
-        basenme = os.path.split(infile)[1]
-        newfile = os.path.join(newdir, basenme)
-        return newfile
+    return newfile
 
 def convert(infile, outfile):
     """converts freesurfer .mgz format to nifti
@@ -297,15 +374,11 @@ def ecat2nifti(ecat, newname):
     else:
         return True
 
-def copy_dir(dir, dest, pattern='*'):
+def copy_dir(dir, dest, pattern='*', nthreads=8):
       """copies files matching pattern in dir to dest
       returns list of abspath to new copied items """
       items = glob('%s/%s'%(dir,pattern))
-      newitems = []
-      for item in items:
-            newitem = copy_file(item, dest)
-            newitems.append(newitem)
-      return newitems
+      return copy_files(items, dest, nthreads=nthreads)
 
 
 def unzip_file(infile):
@@ -315,33 +388,165 @@ def unzip_file(infile):
     if not ext == '.gz':
         return infile
     else:
-        cmd = CommandLine('gunzip %s' % infile)
-        cout = cmd.run()
-        if not cout.runtime.returncode == 0:
-            print 'Failed to unzip %s'%(infile)
+        try:
+            _gzip_copy(gzip.open(infile, 'rb'), open(base, 'wb'))
+            shutil.copystat(infile, base)
+            os.remove(infile)
+        except (IOError, OSError) as e:
+            print 'Failed to unzip %s: %s'%(infile, e)
             return None
-        else:
-            return base
-
-def unzip_files(inlist):
-    result = []
-    for f in inlist:
-        unzipped = unzip_file(f)
-        result.append(unzipped)
-    return result
+        return base
+
+def unzip_files(inlist, nthreads=8):
+    """ unzips files in a pool of threads,
+    returns list of unzipped filenames"""
+    return _pool_map(unzip_file, inlist, nthreads)
+
+def _gzip_copy(src, dst):
+    """ copies between open files, then closes them,
+    removing dst if the copy fails"""
+    try:
+        try:
+            shutil.copyfileobj(src, dst, 2**20)
+        finally:
+            src.close()
+            dst.close()
+    except:
+        os.remove(dst.name)
+        raise
+
+def zip_file(infile):
+    """ gzips infile (removing infile), returns gzipped filename"""
+    base, ext = os.path.splitext(infile)
+    if 'gz' in ext:
+        # file already gzipped
+        return infile
+    newfile = infile + '.gz'
+    try:
+        _gzip_copy(open(infile, 'rb'), gzip.open(newfile, 'wb'))
+        shutil.copystat(infile, newfile)
+        os.remove(infile)
+    except (IOError, OSError) as e:
+        logging.error('Failed to zip %s: %s'%(infile, e))
+        return None
+    return newfile
 
-def zip_files(files):
+def zip_files(files, nthreads=8):
+    """ gzips files in a pool of threads,
+    returns list of gzipped filenames"""
     if not hasattr(files, '__iter__'):
         files = [files]
-    for f in files:
-        base, ext = os.path.splitext(f)
-        if 'gz' in ext:
-            # file already gzipped
-            continue
-        cmd = CommandLine('gzip %s' % f)
-        cout = cmd.run()
-        if not cout.runtime.returncode == 0:
-            logging.error('Failed to zip %s'%(f))
+    return _pool_map(zip_file, files, nthreads)
+
+def copy_uncompressed(infile, newdir):
+    """ copies infile to newdir, gunzipping on the way if it is .gz
+    (the source is left as is), returns the new (uncompressed) file"""
+    base, ext = os.path.splitext(infile)
+    if not ext == '.gz':
+        return copy_file(infile, newdir)
+    newfile = os.path.join(newdir, os.path.split(base)[1])
+    try:
+        _gzip_copy(gzip.open(infile, 'rb'), open(newfile, 'wb'))
+    except (IOError, OSError) as e:
+        print 'failed to copy %s: %s'%(infile, e)
+        return None
+    return newfile
+
+
+class ScratchCache():
+    """ uncompressed copies of .nii.gz files for external tools (SPM)
+    that can not read them, kept in a scratch directory so the
+    originals are never gunzipped and re-gzipped in place
+
+    copies are keyed by source path, size and mtime, the least
+    recently used are evicted to keep the cache under maxbytes.
+    Only use copies as inputs a tool reads (eg space defining image,
+    target, template), tools that write next to / modify their
+    inputs need their own copy (see copy_uncompressed)
+    """
+    def __init__(self, scratchdir=None, maxbytes=4 * 2**30):
+        if scratchdir is None:
+            scratchdir = os.path.join(tempfile.gettempdir(),
+                                      'petproc_scratch_%s'%(os.getuid()))
+        self.scratchdir = scratchdir
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+
+    def filename(self, infile):
+        """ name of uncompressed copy of infile in the cache"""
+        infile = os.path.abspath(infile)
+        stat = os.stat(infile)
+        key = '%s %d %d'%(infile, stat.st_size, int(stat.st_mtime))
+        _, nme = os.path.split(infile)
+        return os.path.join(self.scratchdir, '%s_%s'%(
+            hashlib.md5(key).hexdigest()[:12], nme[:-3]))
+
+    def get(self, infile):
+        """ returns infile if not gzipped, else path of an
+        uncompressed copy in the cache (made if needed)"""
+        if not infile.endswith('.gz'):
+            return infile
+        if not os.path.isdir(self.scratchdir):
+            try:
+                os.makedirs(self.scratchdir)
+            except OSError:
+                # made by another process
+                pass
+        newfile = self.filename(infile)
+        if os.path.isfile(newfile):
+            # mtime is the recently used clock
+            os.utime(newfile, None)
+            return newfile
+        def write(tmpfile):
+            _gzip_copy(gzip.open(infile, 'rb'), open(tmpfile, 'wb'))
+        atomic_write(newfile, write)
+        self.evict(keep=newfile)
+        return newfile
+
+    def evict(self, keep=None):
+        """ removes least recently used copies until the cache
+        is under maxbytes (never removes keep)"""
+        with self.lock:
+            items = []
+            for nme in os.listdir(self.scratchdir):
+                if nme.startswith('.tmp_'):
+                    continue
+                f = os.path.join(self.scratchdir, nme)
+                try:
+                    stat = os.stat(f)
+                except OSError:
+                    continue
+                items.append((stat.st_mtime, stat.st_size, f))
+            items.sort()
+            total = sum([x[1] for x in items])
+            for mtime, size, f in items:
+                if total <= self.maxbytes:
+                    break
+                if f == keep:
+                    continue
+                try:
+                    os.remove(f)
+                except OSError:
+                    continue
+                total -= size
+            return total
+
+    def clear(self):
+        """ removes all copies"""
+        if os.path.isdir(self.scratchdir):
+            shutil.rmtree(self.scratchdir, ignore_errors=True)
+
+
+# shared cache, see uncompressed
+scratch_cache = ScratchCache()
+
+def uncompressed(infile, cache=None):
+    """ returns path to an uncompressed version of infile for
+    tools that can not read .nii.gz (infile itself if not gzipped),
+    the copy lives in the scratch cache and must only be read"""
+    if cache is None:
+        cache = scratch_cache
+    return cache.get(infile)
           
       
 
@@ -352,13 +557,13 @@ def convertallecat(ecats, newname):
             os.remove(f)
 
 def tar_cmd(infile):
-    """ given a ipped tar archive, untars"""
-    cwd = os.getcwd()
-    pth, nme = os.path.split(infile)
-    os.chdir(pth)
-    cl = CommandLine('tar xfvz %s'%(infile))
-    cout = cl.run()
-    os.chdir(cwd)
+    """ given a ipped tar archive, untars into its directory"""
+    pth, nme = os.path.split(os.path.abspath(infile))
+    tar = tarfile.open(infile, 'r:*')
+    try:
+        tar.extractall(pth)
+    finally:
+        tar.close()
     return pth
 
 def find_dicoms(pth):
@@ -522,114 +727,106 @@ def move_and_convert(mgz, dest, newname):
       os.remove(new_mgz)
       return nii
 
-def make_brainstem(aseg):
+# freesurfer labels making up each reference region
+# (None is all non-zero labels)
+REFERENCE_LABELS = {
+      'grey_cerebellum' : [8, 47],
+      'whole_cerebellum' : [7, 8, 46, 47],
+      'brainstem' : [16],
+      'brainmask' : None}
+
+def make_label_masks(aseg, regions=('grey_cerebellum',), outdir=None,
+                     labels=None, ext='.nii', values=False):
+      """ loads aseg (or aparc_aseg) once and writes a binary mask
+      for each region, only final outputs are written and the
+      working directory is never changed
+
+      Parameters
+      ----------
+      aseg : label image
+      regions : names of regions to make
+      outdir : directory for outputs (default directory of aseg)
+      labels : dict of region -> list of labels (default REFERENCE_LABELS)
+      ext : extension of outputs (default .nii)
+      values : keep the label values (in the aseg datatype, as
+               fslmaths -thr -uthr) instead of a uint8 0/1 mask
+
+      Returns
+      -------
+      outfiles : dict of region -> mask file  (outdir/<region><ext>)
+
+      raises IOError if a region has no voxels in aseg
+      """
+      if labels is None:
+            labels = REFERENCE_LABELS
+      if outdir is None:
+            outdir, _ = os.path.split(os.path.abspath(aseg))
+      for region in regions:
+            if not region in labels:
+                  raise KeyError('no labels defined for %s'%(region))
+      img = ni.load(aseg)
+      dat = np.round(np.asarray(img.get_data())).astype(np.int32)
+      maxlabel = max(dat.max(), 0)
+      outfiles = {}
+      for region in regions:
+            ids = labels[region]
+            if ids is None:
+                  mask = dat > 0
+            else:
+                  # lookup table, one pass over the labels per region
+                  lut = np.zeros(maxlabel + 1, dtype=bool)
+                  ids = [x for x in ids if 0 <= x <= maxlabel]
+                  lut[ids] = True
+                  mask = lut[dat.clip(0, maxlabel)]
+            if not mask.any():
+                  raise IOError('%s: no voxels found in %s'%(region, aseg))
+            if values:
+                  maskdat = np.where(mask, img.get_data(), 0)
+                  maskdat = maskdat.astype(img.get_data_dtype())
+            else:
+                  maskdat = mask.astype(np.uint8)
+            outfile = os.path.join(outdir, region + ext)
+            # concurrent callers never see (or clobber) a partial mask
+            newimg = ni.Nifti1Image(maskdat, img.get_affine())
+            outfiles[region] = atomic_write(outfile, newimg.to_filename)
+      return outfiles
 
-      cwd = os.getcwd()
-      pth, nme = os.path.split(aseg)
-      os.chdir(pth)
-      cl = CommandLine('fslmaths %s -thr 16 -uthr 16 brainstem'% (aseg))
-      cout = cl.run()
-      os.chdir(cwd)
-      if not cout.runtime.returncode == 0:
-            print 'Unable to create brainstem for %s'%(aseg)
+def make_brainstem(aseg):
+      """ makes brainstem.nii.gz (label 16) in directory of aseg,
+      as fslmaths -thr 16 -uthr 16 brainstem, removes aseg
+      returns 'brainstem' or None on failure"""
+      try:
+            make_label_masks(aseg, ['brainstem'], ext='.nii.gz', values=True)
+      except Exception as e:
+            print 'Unable to create brainstem for %s: %s'%(aseg, e)
             return None
-      else:
-            os.remove(aseg)
-            return 'brainstem'
+      os.remove(aseg)
+      return 'brainstem'
 
-      
 def make_whole_cerebellume(aseg):
-      """
-      os.system('fslmaths rad_aseg -thr 46 -uthr 47 whole_right_cerebellum')
-      os.system('fslmaths rad_aseg -thr 7 -uthr 8 whole_left_cerebellum')
-      os.system('fslmaths whole_left_cerebellum -add whole_right_cerebellum -bin whole_cerebellum')
-      """
-      cwd = os.getcwd()
-      pth, nme = os.path.split(aseg)
-      os.chdir(pth)
-      cmd = 'fslmaths %s -thr 46 -uthr 47 whole_right_cerebellum'%(aseg)
-      cl = CommandLine(cmd)
-      cout = cl.run()
-      if not cout.runtime.returncode == 0:
-            os.chdir(cwd)
-            print 'Unable to create  right whole cerebellum for %s'%(aseg)
-            return None
-      
-      cmd = 'fslmaths %s -thr 7 -uthr 8 whole_left_cerebellum'%(aseg)
-      cl2 = CommandLine(cmd)
-      cout2 = cl2.run()
-      if not cout2.runtime.returncode == 0:
-            os.chdir(cwd)
-            print 'Unable to create  whole left cerebellum for %s'%(aseg)
-            return None     
-
-      cmd = 'fslmaths whole_left_cerebellum -add whole_right_cerebellum' + \
-            ' -bin whole_cerebellum'
-      cl3 = CommandLine(cmd)
-      cout3 = cl3.run()
-      if not cout3.runtime.returncode == 0:
-            os.chdir(cwd)
-            print 'Unable to create  whole cerebellum for %s'%(aseg)
-            print cout3.runtime.stderr
-            print cout3.runtime.stdout
-            return None     
-      cmd = 'rm whole_right_cerebellum.* whole_left_cerebellum.*'
-      cl4 = CommandLine(cmd)
-      cout4 = cl4.run()      
-      whole_cerebellum = glob('%s/whole_cerebellum.*'%(pth))
-      os.chdir(cwd)
-      return whole_cerebellum[0]
-      
-def make_cerebellum(aseg):
-      cwd = os.getcwd()
-      pth, nme = os.path.split(aseg)
-      os.chdir(pth)
-      cl = CommandLine('fslmaths %s -thr 47 -uthr 47 right_cerebellum'% (aseg))
-      cout = cl.run()
-      
-      if not cout.runtime.returncode == 0:
-            os.chdir(cwd)
-            print 'Unable to create  right cerebellum for %s'%(aseg)
+      """ makes whole_cerebellum (labels 7, 8, 46, 47)
+      in directory of aseg"""
+      try:
+            return make_label_masks(aseg,
+                                    ['whole_cerebellum'])['whole_cerebellum']
+      except IOError as e:
+            print 'Unable to create  whole cerebellum for %s: %s'%(aseg, e)
             return None
 
-      cl2 = CommandLine('fslmaths %s -thr 8 -uthr 8 left_cerebellum'% (aseg))
-      cout2 = cl2.run()
-
-      if not cout2.runtime.returncode == 0:
-            os.chdir(cwd)
-            print 'Unable to create  left cerebellum for %s'%(aseg)
+def make_cerebellum(aseg):
+      """ makes grey_cerebellum (labels 8, 47)
+      in directory of aseg"""
+      try:
+            return make_label_masks(aseg,
+                                    ['grey_cerebellum'])['grey_cerebellum']
+      except IOError as e:
+            print 'Unable to create  grey cerebellum for %s: %s'%(aseg, e)
             return None
 
-      cl3 = CommandLine('fslmaths left_cerebellum -add right_cerebellum -bin grey_cerebellum')
-      cout3 = cl3.run()
-      if not cout3.runtime.returncode == 0:
-            print 'Unable to create whole cerebellum for %s'%(aseg)
-            print cout3.runtime.stderr
-            print cout3.runtime.stdout
-            return None
-      
-      cmd = 'rm right_cerebellum.* left_cerebellum.*'
-      cl4 = CommandLine(cmd)
-      cout4 = cl4.run()
-      os.chdir(cwd)
-      cerebellum = glob('%s/grey_cerebellum.*'%(pth))
-      return cerebellum[0]
-
 def make_cerebellum_nibabel(aseg):
       """ use nibabel to make cerebellum"""
-      #cwd = os.getcwd()
-      pth, nme = os.path.split(aseg)
-      #os.chdir(pth)
-      img = ni.load(aseg)
-      newdat = np.zeros(img.get_shape())
-      dat = img.get_data()
-      newdat[dat == 8] = 1
-      newdat[dat == 47] = 1
-      newimg = ni.Nifti1Image(newdat, img.get_affine())
-      newfile = os.path.join(pth, 'grey_cerebellum.nii')
-      newimg.to_filename(newfile)
-      return newfile
-      
+      return make_label_masks(aseg, ['grey_cerebellum'])['grey_cerebellum']
+
 if __name__ == '__main__':
 
     root = '/home/jagust/cindeem/tmpucsf'
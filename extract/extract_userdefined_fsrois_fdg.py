@@ -74,7 +74,6 @@ if __name__ == '__main__':
         if dat is None:
             logging.error('%s missing, skipping'%(globstr))
             continue
-        dat = bg.unzip_file(dat)# in case zipped
         # get raparc
         #if exists: #roidir exists so raparc_aseg should also
         #    globstr = '%s/rB*aparc_aseg.nii*'%(roidir)
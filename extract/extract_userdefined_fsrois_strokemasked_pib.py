@@ -13,14 +13,12 @@ from time import asctime
 
 
 def transform_vol(invol, xfm, space_defining):
-    invol = bg.unzip_file(invol)# in case zipped
+    invol = bg.unzip_file(invol)# in case zipped (copy, removed below)
     xfm =  bg.unzip_file(xfm)# in case zipped
-    space_defining = bg.unzip_file(space_defining)# in case zipped
     pp.apply_transform_onefile(xfm, invol)
     pp.reslice(space_defining, invol)
     rinvol = pp.prefix_filename(invol, prefix='r')
     bg.remove_files([invol])
-    bg.zip_files([space_defining])
     return rinvol
 
 if __name__ == '__main__':
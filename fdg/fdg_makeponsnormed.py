@@ -61,6 +61,7 @@ if __name__ == '__main__':
                            indir='%s/'%root)
 
     subs.sort()
+    jobs = []
     for sub in subs:
         _, subid = os.path.split(sub)
         logging.info('%s'%subid)
@@ -79,12 +80,18 @@ if __name__ == '__main__':
         searchstr = '%s/fdg/ref_region/rpons_tu.nii*' % sub
         pons = pp.find_single_file(searchstr)
         if pons is None:
-            logging.error('%s not found'%(searchstring))
+            logging.error('%s not found'%(searchstr))
             continue
         outfname = os.path.join(sub, 'fdg', 
                                 'ponsnormed_%s_%s.nii'%(subid,
                                                         tracer.lower()))
-        pp.make_pons_normed(pet, newpons, outfname)
-        no_nanfiles = pp.clean_nan([outfname])
-        logging.info('saved %s'%(outfname))
+        jobs.append((sum, pons, outfname))
 
+    # normalize all subjects in parallel
+    results = pp.normalize_reference_batch(jobs)
+    for result in results:
+        if result is None:
+            continue
+        outfname, ponsval = result
+        no_nanfiles = pp.clean_nan([outfname])
+        logging.info('saved %s (pons mean %f)'%(outfname, ponsval))
@@ -108,10 +108,9 @@ if __name__ == '__main__':
         if not hasqa:
             logging.info( 'qa %s' % subid)
             qa.plot_movement(tmpparameterfile,subid)
-            # get rid of NAN in files
-            no_nanfiles = pp.clean_nan(tmprealigned)
-            #make 4d volume to visualize movement
-            img4d = qa.make_4d_nibabel(no_nanfiles)
+            #make 4d volume to visualize movement (NaN free view,
+            # no nonan- copies written)
+            img4d = qa.make_4d_nibabel(pp.nan_cleaned(tmprealigned))
             bg.zip_files(tmprealigned)
             #save qa image
             #qa.save_qa_img(img4d)
@@ -120,7 +119,6 @@ if __name__ == '__main__':
             qa.screen_pet(img4d) 
             #remove tmpfiles
 
-            bg.remove_files(no_nanfiles)
             bg.remove_files(newnifti)
 
         # coreg pons to pet
@@ -160,43 +158,49 @@ if __name__ == '__main__':
         caparc = bg.copy_file(aparc, coreg_dir)
         xfm_file = pp.make_transform_name(cpet, cmri)
         logging.info( 'coreg %s'%(subid))
-        corg_out = pp.invert_coreg(cmri, cpet, xfm_file)
-        if not corg_out.runtime.returncode == 0:
-            logging.warning(corg_out.runtime.stderr)
+        try:
+            pp.invert_coreg(cmri, cpet, xfm_file)
+        except IOError as e:
+            logging.warning(e)
             continue
-        apply_out = pp.apply_transform_onefile(xfm_file,cpons)
-        if not apply_out.runtime.returncode == 0:
-            logging.warning(apply_out.runtime.stderr)
+        try:
+            pp.apply_transform_onefile(xfm_file,cpons)
+            pp.apply_transform_onefile(xfm_file,caparc)
+        except IOError as e:
+            logging.warning(e)
             continue
-        apply_out = pp.apply_transform_onefile(xfm_file,caparc)
-        if not apply_out.runtime.returncode == 0:
-            logging.warning(apply_out.runtime.stderr)
-            continue
-        rout_mri = pp.reslice(cpet, cmri)
-        if not rout_mri.runtime.returncode == 0:
-            logging.warning(rout_mri.runtime.stderr)
+        # each reslice on its own, a failure only skips that volume
+        # (volumes on the same grid still share one resample plan)
+        try:
+            rmri = pp.reslice(cpet, cmri)
+        except IOError as e:
+            logging.warning(e)
         else:
-            rmri = pp.prefix_filename(cmri, prefix='r')
             _, rmri_nme = os.path.split(rmri)
             new_rmri = rmri_nme.replace('rbr', 'rfdg_br')
             newmri = bg.copy_file(rmri, '%s/anatomy/%s'%(sub,new_rmri))
             if newmri:
                 bg.remove_files([cmri,rmri])
-        rout_pons = pp.reslice(cpet, cpons)
-        if not rout_pons.runtime.returncode == 0:
-            logging.warning(rout_pons.runtime.stderr)
+        newpons = None
+        try:
+            rpons = pp.reslice(cpet, cpons)
+        except IOError as e:
+            logging.warning(e)
         else:
-            rpons = pp.prefix_filename(cpons, prefix='r')
             newpons = bg.copy_file(rpons, '%s/ref_region'%(tracerdir))
             if newpons:
                 bg.remove_files([cpons,rpons])
-        rout_aparc = pp.reslice(cpet, caparc)
-        if not rout_aparc.runtime.returncode == 0:
-            logging.warning(rout_aparc.runtime.stderr)
+        try:
+            pp.reslice(cpet, caparc)
+        except IOError as e:
+            logging.warning(e)
         bg.remove_files(cpet)
         bg.remove_files(caparc)
         bg.zip_files(aparc)
         bg.zip_files(nifti)
+        if newpons is None:
+            logging.warning('no resliced pons for %s, skipping'%(subid))
+            continue
 
         # pons norm
         outfname = os.path.join(tracerdir,
@@ -74,7 +74,6 @@ if __name__ == '__main__':
             logging.error('%s not found. skipping'%globstr)
             shutil.rmtree(warpdir)
             continue
-        pnfdg = bg.unzip_file(pnfdg)
         # get summed fdg
         globstr = os.path.join(tracerdir,  'sum_rB*.nii*')
         sumfdg = pp.find_single_file(globstr)
@@ -82,7 +81,6 @@ if __name__ == '__main__':
             logging.error('%s not found. skipping'%globstr)
             shutil.rmtree(warpdir)
             continue
-        sumfdg = bg.unzip_file(sumfdg)        
         # brainmask
         globstr = os.path.join(anatdir, 'brainmask.nii*')
         brainmask = pp.find_single_file(globstr)
@@ -90,11 +88,10 @@ if __name__ == '__main__':
             logging.error('%s not found. skipping'%globstr)
             shutil.rmtree(warpdir)
             continue
-        brainmask = bg.unzip_file(brainmask)
-        # copy to warp dir
-        csumfdg = bg.copy_file(sumfdg, warpdir)
-        cpnfdg = bg.copy_file(pnfdg, warpdir)
-        cbm = bg.copy_file(brainmask, warpdir)
+        # copy to warp dir (unzipping the copies, originals left as is)
+        csumfdg = bg.copy_uncompressed(sumfdg, warpdir)
+        cpnfdg = bg.copy_uncompressed(pnfdg, warpdir)
+        cbm = bg.copy_uncompressed(brainmask, warpdir)
         # coreg pet to brainmask
         logging.info('Run coreg')
         # cast everything to string
@@ -0,0 +1,73 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+file writing helpers shared by the gui, pipeline and pyga modules
+(no gui or nipype imports, so headless code can use them)
+"""
+import os
+import tempfile
+
+
+def atomic_write(outfile, write, mode=0o644):
+    """ writes outfile through a tmp file and renames it into place
+
+    the tmp file is made with tempfile.mkstemp in the directory of
+    outfile, so readers never see a partial file and concurrent
+    writers of the same outfile never share a tmp file (the last
+    rename wins). The tmp file is removed if write fails.
+
+    Parameters
+    ----------
+    outfile : file to write
+    write : function called with the tmp filename, writes the contents
+            (the tmp file keeps the extension of outfile, eg .nii.gz,
+            for writers that pick the format from it)
+    mode : permissions of outfile (mkstemp files are private)
+
+    Returns
+    -------
+    outfile
+    """
+    pth, nme = os.path.split(os.path.abspath(outfile))
+    if nme.endswith('.nii.gz'):
+        ext = '.nii.gz'
+    else:
+        ext = os.path.splitext(nme)[1]
+    fd, tmpfile = tempfile.mkstemp(prefix='.tmp_', suffix=ext, dir=pth)
+    os.close(fd)
+    try:
+        write(tmpfile)
+        os.chmod(tmpfile, mode)
+        os.rename(tmpfile, outfile)
+    except:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+        raise
+    return outfile
+
+
+if __name__ == '__main__':
+
+    import shutil
+
+    tmpdir = tempfile.mkdtemp()
+    outfile = os.path.join(tmpdir, 'out.txt')
+    def write(tmpfile):
+        fid = open(tmpfile, 'w')
+        fid.write('done\n')
+        fid.close()
+    assert atomic_write(outfile, write) == outfile
+    assert open(outfile).read() == 'done\n'
+    assert os.stat(outfile).st_mode & 0o777 == 0o644
+    # failed writes leave outfile and no tmp files behind
+    def fail(tmpfile):
+        raise IOError('failed write')
+    try:
+        atomic_write(outfile, fail)
+    except IOError:
+        pass
+    else:
+        raise AssertionError('atomic_write should raise')
+    assert os.listdir(tmpdir) == ['out.txt']
+    assert open(outfile).read() == 'done\n'
+    shutil.rmtree(tmpdir)
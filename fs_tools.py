@@ -8,6 +8,8 @@ from shutil import rmtree
 sys.path.insert(0,'/home/jagust/cindeem/CODE/PetProcessing')
 import base_gui as bg
 import csv
+import numpy as np
+import nibabel
 from nipype.interfaces.base import CommandLine
 from nipype.utils.filemanip import split_filename, fname_presuffix
 
@@ -205,28 +207,10 @@ def roilabels_fromcsv(infile):
     return roid
 
 def mean_from_labels(roid, labelimg, data, othermask = None):
-    meand = {}
-    labels = nibabel.load(labelimg).get_data()
-    if not labels.shape == data.shape:
-        return None
-    allmask = np.zeros(labels.shape, dtype=bool)
-    for roi, mask in roid.items():
-        fullmask = np.zeros(labels.shape, dtype=bool)
-        for label_id in mask:
-            fullmask = np.logical_or(fullmask, labels == label_id)
-            data_mask = np.logical_and(data>0, np.isfinite(data))
-            fullmask = np.logical_and(fullmask, data_mask)
-            if othermask is not None:
-                maskdat = nibabel.load(othermask).get_data()
-                fullmask = np.logical_and(fullmask, maskdat > 0)
-            # update allmask
-            allmask = np.logical_or(allmask, fullmask)
-            roimean = data[fullmask].mean()
-            roinvox = data[fullmask].shape[0]
-            meand[roi] = [roimean, roinvox]
-    # get values of all regions
-    meand['ALL'] = [data[allmask].mean(), data[allmask].shape[0]]
-    return meand
+    """ see preprocessing.mean_from_labels"""
+    # imported here, preprocessing pulls in nipype spm
+    import preprocessing as pp
+    return pp.mean_from_labels(roid, labelimg, data, othermask=othermask)
 
 def mean_from_labels_percent(roid, labelimg, data, percent = .50):
     meand = {}
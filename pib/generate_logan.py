@@ -95,10 +95,11 @@ if __name__ == '__main__':
             continue
         
         midtimes, durs = pyl.midframes_from_file(timingf)
-        data4d = pyl.get_data_nibabel(nifti)
-        ref = pyl.get_ref(rcere, data4d)
+        masked_data, mask_roi, refs = pyl.load_masked_frames(nifti,
+                                                             rbrainmask,
+                                                             refrois=[rcere])
+        ref = refs[0]
         ref_fig = pyl.save_inputplot(ref, (midtimes + durs/2.), dvrdir)
-        masked_data, mask_roi = pyl.mask_data(rbrainmask, data4d)
         x,y  = pyl.calc_xy(ref, masked_data, midtimes)
         allki, residuals = pyl.calc_ki(x, y, timingf, range=range)
         dvr = pyl.results_to_array(allki, mask_roi)
@@ -0,0 +1,331 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+#!/usr/bin/env python
+"""
+Headless, parallel version of generate_logan.py
+
+for each subject directory (given as paths or globs)
+   finds realigned pib nifti files (realign_QA dir)
+   finds coregistered brainmask, and cerebellum (coreg directory)
+   generates frametimes from raw pet
+   calcs dvr (streams frames, ref TAC, calc_xy, calc_ki)
+   optionally pulls PIBINDEX values with an roi csv file
+
+subjects are run across a pool of worker processes, a completion
+marker is written in each dvr directory so re-running the same list
+only processes subjects that did not finish
+"""
+import sys, os
+from glob import glob
+import argparse
+import multiprocessing
+import logging, logging.config
+from time import asctime
+import matplotlib
+matplotlib.use('Agg') # no display on batch nodes
+import numpy as np
+import nibabel as ni
+sys.path.insert(0, '/home/jagust/cindeem/CODE/PetProcessing')
+import preprocessing as pp
+from fileio import atomic_write
+sys.path.insert(0, '/home/jagust/cindeem/CODE/PetProcessing/pyga')
+import frametimes as ft
+import py_logan as pyl
+
+DONE_MARKER = 'LOGAN_COMPLETE'
+# approximate bytes needed per masked voxel per frame
+# (float32 frames, float64 x, y and fit temporaries)
+BYTES_PER_VOXFRAME = 56
+
+
+def find_subject_inputs(sub, tracer='PIB', nframes=34):
+    """finds realigned frames, brainmask, cerebellum and raw ecats
+    for a subject directory
+    returns dict of inputs, or None and an error message"""
+    _, subid = os.path.split(sub.rstrip('/'))
+    pth = os.path.join(sub, tracer.lower())
+    realigndir = os.path.join(pth, 'realign_QA')
+    nifti = glob('%s/r%s_PIB*.nii'%(realigndir, subid))
+    nifti.sort()
+    if len(nifti) < nframes:
+        return None, '%s only has %d frames, RUNBYHAND'%(subid, len(nifti))
+    corgdir = os.path.join(pth, 'coreg')
+    rbrainmask = pp.find_single_file('%s/rbrainmask.nii'%(corgdir))
+    if rbrainmask is None:
+        return None, '%s/rbrainmask.nii missing, skipping'%(corgdir)
+    rcere = pp.find_single_file('%s/rgrey_cerebellum.nii'%(corgdir))
+    if rcere is None:
+        return None, '%s/rgrey_cerebellum.nii missing, skipping'%(corgdir)
+    ecats = glob(os.path.join(sub, 'raw', '*.v'))
+    if len(ecats) < 1:
+        ecats = glob(os.path.join(sub, 'RawData', tracer, '*.v'))
+    if len(ecats) < 1:
+        return None, 'no raw .v files for %s, skipping'%(subid)
+    raparc = pp.find_single_file('%s/rB*aparc_aseg.nii'%(corgdir))
+    return dict(subid=subid, sub=sub, pth=pth, nifti=nifti,
+                rbrainmask=rbrainmask, rcere=rcere, ecats=ecats,
+                raparc=raparc,
+                dvrdir=os.path.join(pth, 'dvr')), None
+
+
+def estimate_memory(inputs):
+    """ estimated peak bytes to run logan on one subject"""
+    mask = ni.load(inputs['rbrainmask'])
+    nvox = (mask.get_data() > 0).sum()
+    nframes = len(inputs['nifti'])
+    # plus a few full volumes (frame, dvr, resid, mask)
+    return nvox * nframes * BYTES_PER_VOXFRAME + \
+           4 * np.prod(mask.get_shape()) * 8
+
+
+def is_complete(dvrdir):
+    """ checks for the completion marker in dvrdir"""
+    return os.path.isfile(os.path.join(dvrdir, DONE_MARKER))
+
+
+def write_marker(dvrdir, outfiles):
+    """ writes completion marker listing outfiles, written to a tmp
+    file and renamed so a partial marker is never seen"""
+    def write(tmpfile):
+        fid = open(tmpfile, 'w')
+        fid.write('\n'.join(outfiles) + '\n')
+        fid.close()
+    return atomic_write(os.path.join(dvrdir, DONE_MARKER), write)
+
+
+def run_subject(args):
+    """ runs logan on one subject, args is (inputs, k2ref, range, roifile)
+    returns subid, success, message"""
+    inputs, k2ref, range, roifile = args
+    subid = inputs['subid']
+    try:
+        dvrdir = inputs['dvrdir']
+        if not os.path.isdir(dvrdir):
+            os.mkdir(dvrdir)
+        cleantime = asctime().replace(' ','-').replace(':', '-')
+        # frametimes
+        ftimes = ft.frametimes_from_ecats(inputs['ecats'])
+        ftimes = ft.frametimes_to_seconds(ftimes)
+        timingf = ft.make_outfile(inputs['ecats'][0])
+        ft.write_frametimes(ftimes, timingf)
+        midtimes, durs = pyl.midframes_from_file(timingf)
+        # frames, ref TAC
+        masked_data, mask_roi, refs = pyl.load_masked_frames(
+            inputs['nifti'], inputs['rbrainmask'], refrois=[inputs['rcere']])
+        ref = refs[0]
+        ref_fig = pyl.save_inputplot(ref, (midtimes + durs/2.), dvrdir)
+        # logan
+        x, y = pyl.calc_xy(ref, masked_data, midtimes, k2ref=k2ref)
+        del masked_data
+        allki, residuals = pyl.calc_ki(x, y, timingf, range=range)
+        del x, y
+        dvr = pyl.results_to_array(allki, mask_roi)
+        resid = pyl.results_to_array(residuals, mask_roi)
+        outf = pyl.save_data2nii(dvr, inputs['rbrainmask'],
+                                 filename='DVR-%s'%subid, outdir=dvrdir)
+        residf = pyl.save_data2nii(resid, inputs['rbrainmask'],
+                                   filename='RESID-%s'%subid, outdir=dvrdir)
+        outfiles = [timingf, ref_fig, outf, residf]
+        message = 'Finished Logan: %s'%(outf)
+        # pibindex
+        if roifile is not None:
+            if inputs['raparc'] is None:
+                message += ', no aparc_aseg, unable to get pibindex'
+            else:
+                roid = pp.roilabels_fromcsv(roifile)
+                meand = pp.mean_from_labels(roid, inputs['raparc'], dvr)
+                csvfile = os.path.join(dvrdir,
+                                       'PIBINDEX_%s_%s.csv'%(subid, cleantime))
+                pp.meand_to_file(meand, csvfile)
+                outfiles.append(csvfile)
+        write_marker(dvrdir, outfiles)
+        return subid, True, message
+    except Exception as e:
+        return subid, False, 'FAILED %s: %s'%(type(e).__name__, e)
+
+
+def main(subjects, nworkers=None, mem_gb=None, k2ref=0.15, range=(35,90),
+         roifile=None, force=False):
+    """ runs logan across subjects (dirs or globs) in a process pool
+
+    Parameters
+    ----------
+    subjects : list of subject directories or globs
+    nworkers : number of worker processes (default all cpus)
+    mem_gb : memory budget in GB shared by all workers, limits the
+             number of workers so the largest subjects fit (default None)
+    force : rerun subjects that already have a completion marker
+    """
+    subdirs = []
+    for item in subjects:
+        subdirs.extend(sorted(glob(item)))
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+
+    jobs = []
+    estimates = []
+    for sub in subdirs:
+        inputs, msg = find_subject_inputs(sub)
+        if inputs is None:
+            logging.error(msg)
+            continue
+        if not force and is_complete(inputs['dvrdir']):
+            logging.info('%s complete, skipping'%(inputs['subid']))
+            continue
+        nbytes = estimate_memory(inputs)
+        if mem_gb is not None and nbytes > mem_gb * 2**30:
+            logging.error('%s needs ~%2.1f GB, over budget, skipping'%(
+                inputs['subid'], nbytes / 2.**30))
+            continue
+        jobs.append((inputs, k2ref, range, roifile))
+        estimates.append(nbytes)
+    if len(jobs) < 1:
+        logging.info('no subjects to run')
+        return []
+    if mem_gb is not None:
+        fit = int(mem_gb * 2**30 // max(estimates))
+        if fit < nworkers:
+            logging.info('memory budget %2.1f GB limits workers to %d'%(mem_gb,
+                                                                       fit))
+            nworkers = fit
+    nworkers = max(1, min(nworkers, len(jobs)))
+    logging.info('Running Logan on %d subjects, %d workers'%(len(jobs),
+                                                             nworkers))
+    # one subject per child, so memory is handed back between subjects
+    pool = multiprocessing.Pool(nworkers, maxtasksperchild=1)
+    results = []
+    for subid, success, message in pool.imap_unordered(run_subject, jobs):
+        if success:
+            logging.info('%s %s'%(subid, message))
+        else:
+            logging.error('%s %s'%(subid, message))
+        results.append((subid, success, message))
+    pool.close()
+    pool.join()
+    return results
+
+
+def self_check():
+    """ checks input discovery, memory estimate, completion marker and
+    the pool driver on synthetic subjects in a temporary directory
+    (the fake raw files make logan fail, which must be reported and
+    leave no marker)"""
+    import tempfile, shutil
+    root = tempfile.mkdtemp()
+    try:
+        affine = np.eye(4)
+        mask = np.zeros((4, 4, 4), dtype=np.uint8)
+        mask[1:3, 1:3, 1:3] = 1
+        for subid, nframes in [('B01-001', 34), ('B01-002', 3)]:
+            sub = os.path.join(root, subid)
+            for dirname in ['realign_QA', 'coreg']:
+                os.makedirs(os.path.join(sub, 'pib', dirname))
+            os.mkdir(os.path.join(sub, 'raw'))
+            for frame in range(nframes):
+                outf = os.path.join(sub, 'pib', 'realign_QA',
+                                    'r%s_PIB_frame%02d.nii'%(subid, frame))
+                ni.Nifti1Image(np.ones((4, 4, 4)), affine).to_filename(outf)
+            for name in ['rbrainmask.nii', 'rgrey_cerebellum.nii']:
+                ni.Nifti1Image(mask, affine).to_filename(
+                    os.path.join(sub, 'pib', 'coreg', name))
+            open(os.path.join(sub, 'raw', '%s.v'%subid), 'w').close()
+        # inputs
+        inputs, msg = find_subject_inputs(os.path.join(root, 'B01-001'))
+        np.testing.assert_equal(msg, None)
+        np.testing.assert_equal(len(inputs['nifti']), 34)
+        np.testing.assert_equal(inputs['raparc'], None)
+        short, msg = find_subject_inputs(os.path.join(root, 'B01-002'))
+        np.testing.assert_equal(short, None)
+        np.testing.assert_equal('RUNBYHAND' in msg, True)
+        # memory
+        np.testing.assert_equal(estimate_memory(inputs),
+                                8 * 34 * BYTES_PER_VOXFRAME + 4 * 64 * 8)
+        # marker
+        os.mkdir(inputs['dvrdir'])
+        np.testing.assert_equal(is_complete(inputs['dvrdir']), False)
+        marker = write_marker(inputs['dvrdir'], ['a', 'b'])
+        np.testing.assert_equal(is_complete(inputs['dvrdir']), True)
+        np.testing.assert_equal(open(marker).read(), 'a\nb\n')
+        np.testing.assert_equal(os.listdir(inputs['dvrdir']), [DONE_MARKER])
+        # complete subjects and subjects over budget are not run
+        subjects = [os.path.join(root, 'B01-*')]
+        np.testing.assert_equal(main(subjects, nworkers=2), [])
+        np.testing.assert_equal(main(subjects, nworkers=2, force=True,
+                                     mem_gb=1e-9), [])
+        # failures come back from the pool, no marker is written
+        os.remove(marker)
+        results = main(subjects, nworkers=2)
+        np.testing.assert_equal(len(results), 1)
+        subid, success, message = results[0]
+        np.testing.assert_equal((subid, success), ('B01-001', False))
+        np.testing.assert_equal(message.startswith('FAILED'), True)
+        np.testing.assert_equal(is_complete(inputs['dvrdir']), False)
+    finally:
+        shutil.rmtree(root)
+    print 'generate_logan_batch self check passed'
+
+
+if __name__ == '__main__':
+
+    # create the parser
+    parser = argparse.ArgumentParser(
+        description='Parallel Logan DVR generation for PIB subjects')
+
+    # add the arguments
+    parser.add_argument(
+        'subjects',
+        type = str,
+        nargs = '*', # one or more items (none with -check)
+        help = 'subject directories, or globs (eg "/data/pib/B*")')
+    parser.add_argument(
+        '-n',
+        type = int,
+        dest = 'nworkers',
+        default = None,
+        help = 'number of worker processes (default all cpus)')
+    parser.add_argument(
+        '-mem',
+        type = float,
+        dest = 'mem_gb',
+        default = None,
+        help = 'memory budget in GB shared by all workers (default None)')
+    parser.add_argument(
+        '-roifile',
+        dest = 'roifile',
+        default = None,
+        help = 'roi csv file, if given PIBINDEX values are written')
+    parser.add_argument(
+        '-logdir',
+        dest = 'logdir',
+        default = os.environ.get('HOME', '.'),
+        help = 'directory for the log file (default $HOME)')
+    parser.add_argument(
+        '-force',
+        dest = 'force',
+        action = 'store_true',
+        help = 'rerun subjects that already completed')
+    parser.add_argument(
+        '-check',
+        dest = 'check',
+        action = 'store_true',
+        help = 'run self check on synthetic subjects and exit')
+
+    args = parser.parse_args()
+    if args.check:
+        self_check()
+    elif len(args.subjects) < 1:
+        parser.print_help()
+    else:
+        cleantime = asctime().replace(' ','-').replace(':', '-')
+        _, script = os.path.split(__file__)
+        logfile = os.path.join(args.logdir,
+                               'pib_%s_%s.log'%(script, cleantime))
+        log_settings = pp.get_logging_configdict(logfile)
+        logging.config.dictConfig(log_settings)
+        logging.info('###START pib generate DVR batch :::')
+        logging.info('###USER : %s'%(os.environ.get('USER')))
+        main(args.subjects,
+             nworkers=args.nworkers,
+             mem_gb=args.mem_gb,
+             roifile=args.roifile,
+             force=args.force)
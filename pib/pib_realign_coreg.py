@@ -76,8 +76,14 @@ if __name__ == '__main__':
         # make new mean files(s) based on fully realigned files
         # 1. first 20 mins for coreg (frames 1-23)
         # 2. 40-60 mins for possible SUVR (frames 28-31)
-        mean_20min = pp.make_mean_20min(allrealigned)
-        mean_40_60min = pp.make_mean_40_60(allrealigned)
+        # both from one pass over the frames
+        windows = [pp.frame_window(1, 23, prefix='mean20min_'),
+                   pp.frame_window(28, 31, prefix='mean40_60min_')]
+        means = pp.make_mean_windows(allrealigned, windows)
+        if means is None:
+            logging.error('unable to make mean images for %s'%subid)
+            continue
+        mean_20min, mean_40_60min = means
 
         # clean up
         # remove copied unrealigned frames
@@ -133,12 +139,15 @@ if __name__ == '__main__':
         ccere = bg.unzip_file(ccere)
         # have all out files, coreg
         xfm = os.path.join(coregdir, 'mri_to_pet.mat')
-        corgout = pp.invert_coreg(cbrainmask, mean_20min,xfm)
-        pp.reslice(mean_20min, cbrainmask)
+        try:
+            pp.invert_coreg(cbrainmask, mean_20min,xfm)
+        except IOError as e:
+            logging.error(e)
+            continue
         pp.apply_transform_onefile(xfm, ccere)
-        pp.reslice(mean_20min, ccere)
         pp.apply_transform_onefile(xfm, caparc)
-        pp.reslice(mean_20min, caparc)
+        # all share the mri grid, resliced with one coordinate map
+        pp.reslice_files(mean_20min, [cbrainmask, ccere, caparc])
         
         
         
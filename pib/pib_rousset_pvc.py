@@ -91,7 +91,7 @@ if __name__ == '__main__':
         rousset.to_file(gm, aff, gmf)
         rousset.to_file(pibi, aff, pibif)
         rois = [gmf, wmf, pibif]
-        rsfs = rousset.compute_rsf(rois)
+        rsfs = rousset.compute_rsf_batch(rois)
         transfer_mtx = rousset.gen_transfer_matrix(rsfs, rois)
         obs = rousset.get_observed_conc(cdvr, rois)
         transferf = os.path.join(pvcdir, 'transfer_matrix')
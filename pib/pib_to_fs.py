@@ -77,10 +77,8 @@ if __name__ == '__main__':
             logging.error('pet2mri sum: %s brainmask: %s'%(sum, brainmask))
             continue
         # move dvr and sum to coregdir, unzip if necessary
-        cdvr = bg.copy_file(dvr, coregdir)
-        csum = bg.copy_file(sum, coregdir)
-        cdvr = bg.unzip_file(cdvr)
-        csum = bg.unzip_file(csum)
+        cdvr = bg.copy_uncompressed(dvr, coregdir)
+        csum = bg.copy_uncompressed(sum, coregdir)
         ## coreg pet 2 brainmask
         corg_out = pp.simple_coregister(str(brainmask),
                                         str(csum),
@@ -77,7 +77,6 @@ if __name__ == '__main__':
             logging.error('%s not found. skipping'%globstr)
             shutil.rmtree(warpdir)
             continue
-        dvr = bg.unzip_file(dvr)
         # get mean 20 minute pib
         globstr = os.path.join(sub,'pib','realign_QA', 'mean20min*.nii*')
         mean20 = pp.find_single_file(globstr)
@@ -85,7 +84,6 @@ if __name__ == '__main__':
             logging.error('%s not found. skipping'%globstr)
             shutil.rmtree(warpdir)
             continue
-        mean20 = bg.unzip_file(mean20)        
         # brainmask
         globstr = os.path.join(anatdir, 'brainmask.nii*')
         brainmask = pp.find_single_file(globstr)
@@ -93,11 +91,10 @@ if __name__ == '__main__':
             logging.error('%s not found. skipping'%globstr)
             shutil.rmtree(warpdir)
             continue
-        brainmask = bg.unzip_file(brainmask)
-        # copy to warp dir
-        cmean20 = bg.copy_file(mean20, warpdir)
-        cdvr = bg.copy_file(dvr, warpdir)
-        cbm = bg.copy_file(brainmask, warpdir)
+        # copy to warp dir (unzipping the copies, originals left as is)
+        cmean20 = bg.copy_uncompressed(mean20, warpdir)
+        cdvr = bg.copy_uncompressed(dvr, warpdir)
+        cbm = bg.copy_uncompressed(brainmask, warpdir)
         # coreg pet to brainmask
         logging.info('Run coreg')
         # cast everything to string
@@ -4,17 +4,24 @@ import os, sys, re
 from glob import glob
 import tempfile
 import logging
+import threading
+import json
+import hashlib
+import multiprocessing
+from collections import OrderedDict
 from shutil import rmtree
 sys.path.insert(0,'/home/jagust/cindeem/CODE/PetProcessing')
 
 import nipype.interfaces.spm as spm
 from nipype.interfaces.base import CommandLine
-import nipype.interfaces.matlab as mlab
 from nipype.utils.filemanip import split_filename, fname_presuffix
 import base_gui as bg
 import nibabel
 from numpy import zeros, nan_to_num, mean, logical_and, eye, dot
-from scipy.ndimage import affine_transform
+from scipy.ndimage import affine_transform, gaussian_filter1d, \
+     map_coordinates
+import scipy.io
+import scipy.optimize
 import numpy as np
 
 sys.path.insert(0, '/home/jagust/cindeem/CODE/GraphicalAnalysis/pyGA')
@@ -152,23 +159,284 @@ def reslice_data(space_define_file, resample_file):
     img : space_define_file as nibabel image
     data : ndarray of data in resample_file sliced to
            shape of space_define_file
+
+    the nearest neighbour mapping for each pair of grids is cached
+    (see resample_plans) so repeat calls are a single gather
     """
     space_define_file = str(space_define_file)
     resample_file = str(resample_file)
     img = nibabel.load(space_define_file)
     change_img = nibabel.load(resample_file)
-    T = eye(4)
-    
-    Tv = dot(np.linalg.inv(change_img.get_affine()), 
-             dot(T, img.get_affine()))
-    data = affine_transform(change_img.get_data().squeeze(), 
-                            Tv[0:3,0:3], 
-                            offset=Tv[0:3,3], 
-                            output_shape = img.get_shape()[:3],
-                            order=0,mode = 'nearest')
-
+    dat = change_img.get_data()
+    if dat.ndim > 3 and np.prod(dat.shape[3:]) == 1:
+        dat = dat.reshape(dat.shape[:3])
+    plan = resample_plans.get(change_img.get_affine(), dat.shape,
+                              img.get_affine(), img.get_shape(),
+                              interp='nearest', mode='nearest')
+    data = plan.apply(dat)
     return img, data
 
+class ResamplePlan():
+    """ precomputed mapping of a target voxel grid into a source grid
+    (both given as affine, shape), applied to any number of volumes
+    on the source grid with a single gather
+
+    Parameters
+    ----------
+    src_affine, src_shape : voxel to world and shape of data to resample
+    target_affine, target_shape : grid to resample onto
+    interp : 'nearest', 'linear' (trilinear), or
+             'label' (label with most trilinear weight, for label images)
+    mode : 'constant' outside source is fill,
+           'nearest' outside source takes the nearest edge voxel
+    """
+    # voxels this far (in voxels) outside the source still count
+    # as inside, as tiny in spm_reslice
+    tiny = 5e-2
+
+    def __init__(self, src_affine, src_shape, target_affine, target_shape,
+                 interp='nearest', mode='constant'):
+        if not interp in ('nearest', 'linear', 'label'):
+            raise ValueError('unknown interp %s'%(interp))
+        self.src_shape = tuple([int(x) for x in src_shape[:3]])
+        self.target_shape = tuple([int(x) for x in target_shape[:3]])
+        self.interp = interp
+        self.mode = mode
+        # target voxel -> source voxel
+        Tv = dot(np.linalg.inv(src_affine), target_affine)
+        coords = self._coords(Tv)
+        dims = np.array(self.src_shape).reshape((3, 1))
+        # inside the source volume (as spm_reslice mask, for all interp)
+        self.valid = np.all((coords >= -self.tiny) &
+                            (coords <= dims - 1 + self.tiny), axis=0)
+        if interp == 'nearest':
+            # same rounding as affine_transform order=0
+            vox = np.floor(coords + 0.5).astype(np.int64)
+            vox = np.clip(vox, 0, dims - 1)
+            self.index = np.ravel_multi_index(vox, self.src_shape)
+            self.weights = None
+        else:
+            base = np.floor(coords)
+            frac = (coords - base).astype(np.float32)
+            base = base.astype(np.int64)
+            index = []
+            weights = []
+            for corner in np.ndindex(2, 2, 2):
+                offset = np.array(corner).reshape((3, 1))
+                vox = np.clip(base + offset, 0, dims - 1)
+                index.append(np.ravel_multi_index(vox, self.src_shape))
+                weights.append(np.prod(np.where(offset, frac, 1 - frac),
+                                       axis=0))
+            self.index = np.array(index)
+            self.weights = np.array(weights, dtype=np.float32)
+        if mode == 'nearest':
+            self.valid[:] = True
+
+    def _coords(self, Tv):
+        """ source voxel coordinates (3, nvox) of every target voxel"""
+        grid = np.indices(self.target_shape, dtype=np.float64).reshape((3, -1))
+        return dot(Tv[:3,:3], grid) + Tv[:3,3:]
+
+    def nbytes(self):
+        """ memory used by the plan"""
+        total = self.index.nbytes + self.valid.nbytes
+        if self.weights is not None:
+            total += self.weights.nbytes
+        return total
+
+    def apply(self, data, fill=0):
+        """ resamples data (source shape, optionally with extra
+        trailing dims, eg frames) onto the target grid"""
+        data = np.asarray(data)
+        if not data.shape[:3] == self.src_shape:
+            raise IOError('data shape %s does not match plan %s'%(
+                data.shape, self.src_shape))
+        extra = data.shape[3:]
+        flat = data.reshape((np.prod(self.src_shape), -1))
+        if self.interp == 'nearest':
+            out = flat[self.index]
+        elif self.interp == 'linear':
+            out = np.zeros((self.index.shape[1], flat.shape[1]),
+                           dtype=np.promote_types(flat.dtype, np.float32))
+            for corner in range(8):
+                out += self.weights[corner][:,None] * flat[self.index[corner]]
+        else:
+            out = self._label_vote(flat)
+        if fill is not None and not self.valid.all():
+            out[~self.valid] = fill
+        return out.reshape(self.target_shape + extra)
+
+    def _label_vote(self, flat):
+        """ per target voxel, label of the corners with the most
+        summed trilinear weight"""
+        out = np.empty((self.index.shape[1], flat.shape[1]), dtype=flat.dtype)
+        for col in range(flat.shape[1]):
+            labels = flat[:,col][self.index]
+            score = np.zeros(labels.shape, dtype=np.float32)
+            for corner in range(8):
+                score += (labels == labels[corner]) * self.weights[corner]
+            best = score.argmax(axis=0)
+            out[:,col] = labels[best, np.arange(labels.shape[1])]
+        return out
+
+
+class ResamplePlanCache():
+    """ ResamplePlans keyed by source affine/shape, target affine/shape,
+    interp and mode, least recently used plans are evicted to keep
+    the cache under maxbytes"""
+    def __init__(self, maxbytes=512 * 2**20):
+        self.maxbytes = maxbytes
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, src_affine, src_shape, target_affine, target_shape,
+            interp='nearest', mode='constant'):
+        """ hashable key for a pair of grids"""
+        return (tuple(np.asarray(src_affine, dtype=float).flatten()),
+                tuple([int(x) for x in src_shape[:3]]),
+                tuple(np.asarray(target_affine, dtype=float).flatten()),
+                tuple([int(x) for x in target_shape[:3]]),
+                interp, mode)
+
+    def get(self, src_affine, src_shape, target_affine, target_shape,
+            interp='nearest', mode='constant'):
+        """ returns cached plan, computing it if needed"""
+        key = self.key(src_affine, src_shape, target_affine, target_shape,
+                       interp, mode)
+        with self.lock:
+            if key in self.plans:
+                plan = self.plans.pop(key)
+                self.plans[key] = plan
+                return plan
+        plan = ResamplePlan(src_affine, src_shape, target_affine,
+                            target_shape, interp=interp, mode=mode)
+        with self.lock:
+            self.plans[key] = plan
+            self.evict()
+        return plan
+
+    def nbytes(self):
+        """ memory used by cached plans"""
+        return sum([x.nbytes() for x in self.plans.values()])
+
+    def evict(self):
+        """ drops least recently used plans over maxbytes
+        (always keeps the newest)"""
+        total = self.nbytes()
+        while total > self.maxbytes and len(self.plans) > 1:
+            _, plan = self.plans.popitem(last=False)
+            total -= plan.nbytes()
+
+    def clear(self):
+        self.plans.clear()
+
+
+# shared plans, see reslice_data, reslice_files
+resample_plans = ResamplePlanCache()
+
+
+def resample_volumes(datas, src_affine, target_affine, target_shape,
+                     interp='nearest', fill=0, plan=None):
+    """ resamples a list of arrays sharing one source grid onto
+    target grid, the coordinate map is computed once for all
+    returns list of resampled arrays"""
+    if plan is None:
+        plan = resample_plans.get(src_affine, datas[0].shape, target_affine,
+                                  target_shape, interp=interp)
+    return [plan.apply(x, fill=fill) for x in datas]
+
+
+def reslice_files(space_define, infiles, interp='nearest', prefix='r'):
+    """ resamples infiles into the space of space_define (assumes they
+    are already in register, eg by apply_transform_onefile), writing
+    prefix + infile next to each infile as spm_reslice does
+
+    infiles on the same grid share one coordinate map (resample_plans)
+    interp : 'nearest' (as reslice), 'linear' or 'label'
+
+    Returns
+    -------
+    outfiles : list of resliced files
+    """
+    target = nibabel.load(str(space_define))
+    target_affine = target.get_affine()
+    target_shape = target.get_shape()[:3]
+    outfiles = []
+    for infile in infiles:
+        infile = str(infile)
+        img = nibabel.load(infile)
+        dat = img.get_data()
+        if dat.ndim > 3 and dat.shape[3] == 1:
+            dat = dat.reshape(dat.shape[:3])
+        plan = resample_plans.get(img.get_affine(), dat.shape,
+                                  target_affine, target_shape,
+                                  interp=interp)
+        newdat = plan.apply(dat)
+        newimg = nibabel.Nifti1Image(newdat, target_affine)
+        if interp == 'linear':
+            newimg.set_data_dtype(np.float32)
+        else:
+            newimg.set_data_dtype(img.get_data_dtype())
+        outfile = prefix_filename(infile, prefix=prefix)
+        newimg.to_filename(outfile)
+        outfiles.append(outfile)
+    return outfiles
+
+
+def load_transform(transform):
+    """ loads 4x4 M from spm style .mat file
+    (as saved by invert_coreg, forward_coreg)"""
+    try:
+        M = scipy.io.loadmat(transform)['M']
+    except (KeyError, ValueError) as e:
+        raise IOError('no 4x4 M in %s: %s'%(transform, e))
+    if not M.shape == (4,4):
+        raise IOError('M in %s is not 4x4 %s'%(transform, M.shape))
+    return M
+
+
+def set_space(infile, affine):
+    """ sets the voxel to world mapping of infile (like spm_get_space),
+    for uncompressed nifti only the header is rewritten
+    spm analyze images (no sform/qform) are rewritten, keeping the
+    affine in a .mat next to the .img as spm_get_space does"""
+    img = nibabel.load(infile)
+    if not isinstance(img.get_header(), nibabel.Nifti1Header):
+        if not isinstance(img.get_header(),
+                          nibabel.spm99analyze.Spm99AnalyzeHeader):
+            raise IOError('cannot set space of %s, %s stores no affine'%(
+                infile, img.get_header().__class__.__name__))
+        # copy, the data may be memory mapped from infile
+        dat = np.array(img.get_data())
+        newimg = img.__class__(dat, affine, header=img.get_header())
+        newimg.to_filename(infile)
+        return infile
+    if infile.endswith('.nii') or infile.endswith('.hdr') or \
+       infile.endswith('.img'):
+        hdrfile = infile
+        if infile.endswith('.img'):
+            hdrfile = infile[:-4] + '.hdr'
+        fid = open(hdrfile, 'r+b')
+        # header as on disk (keeps vox_offset)
+        hdr = img.get_header().__class__.from_fileobj(fid)
+        _set_forms(hdr, affine)
+        fid.seek(0)
+        fid.write(hdr.binaryblock)
+        fid.close()
+    else:
+        hdr = img.get_header()
+        _set_forms(hdr, affine)
+        dat = np.asarray(img.get_data())
+        newimg = img.__class__(dat, affine, header=hdr)
+        newimg.to_filename(infile)
+    return infile
+
+def _set_forms(hdr, affine):
+    """ sets sform and qform (keeping a qform code if set)"""
+    qcode = int(hdr['qform_code']) or 2
+    hdr.set_sform(affine, code=2)
+    hdr.set_qform(affine, code=qcode)
+
 
 def roi_stats_nibabel(data, mask, gm=None,gmthresh=0.3):
     """ uses nibabel to pull mean, std, nvox from
@@ -246,6 +514,119 @@ def spm_smooth(infiles, fwhm=8):
     os.chdir(startdir)
     return sout
     
+def fwhm_to_sigma(fwhm, affine):
+    """ converts fwhm in mm (scalar or one per axis) to gaussian
+    sigma in voxels along each axis of the grid defined by affine"""
+    voxsize = np.sqrt((np.asarray(affine)[:3,:3]**2).sum(axis=0))
+    fwhm = np.ones(3) * fwhm
+    return fwhm / np.sqrt(8 * np.log(2)) / voxsize
+
+def smooth_stack(stack, affine, fwhm, method='separable'):
+    """ gaussian smooths a volume (x, y, z) or a stack of volumes
+    (n, x, y, z) all at once, outside the volume is treated as 0
+
+    Parameters
+    ----------
+    stack : array of volume(s)
+    affine : voxel to world of the volumes (for voxel sizes)
+    fwhm : fwhm in mm (scalar or one per axis)
+    method : 'separable' three 1D passes (default),
+             'fft' multiply by cached kernel fft (for large kernels)
+
+    Returns
+    -------
+    smoothed : float32 array, same shape as stack
+    """
+    stack = np.asarray(stack, dtype=np.float32)
+    sigmas = fwhm_to_sigma(fwhm, affine)
+    if method == 'fft':
+        return _fft_smooth(stack, sigmas)
+    offset = stack.ndim - 3
+    out = stack
+    for axis, sigma in enumerate(sigmas):
+        if sigma <= 0:
+            continue
+        out = gaussian_filter1d(out, sigma, axis=axis + offset,
+                                mode='constant', cval=0.0)
+    if out is stack:
+        out = stack.copy()
+    return out
+
+# (padded shape, sigmas) -> rfft of gaussian kernel, see _fft_smooth
+_fft_kernels = OrderedDict()
+FFT_KERNEL_CACHE_SIZE = 8
+
+def _gaussian_1d(sigma, truncate=4.0):
+    """ normalized 1D gaussian, radius truncate * sigma"""
+    if sigma <= 0:
+        return np.ones(1)
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma)**2)
+    return kernel / kernel.sum()
+
+def fft_kernel(shape, sigmas):
+    """ rfftn of the separable gaussian kernel for volumes of shape,
+    zero padded so the filter does not wrap, cached for repeat calls
+    returns kernel fft, padded shape, kernel radii"""
+    kernels = [_gaussian_1d(x) for x in sigmas]
+    radii = [(len(x) - 1) // 2 for x in kernels]
+    padded = tuple([int(n + 2 * r) for n, r in zip(shape, radii)])
+    key = (padded, tuple([round(x, 6) for x in sigmas]))
+    if key in _fft_kernels:
+        kfft = _fft_kernels.pop(key)
+        _fft_kernels[key] = kfft
+        return kfft, padded, radii
+    kernel = np.zeros(padded)
+    # separable kernel centred on voxel 0 (wrapped)
+    full = np.einsum('i,j,k->ijk', *kernels)
+    idx = [np.arange(-r, r + 1) % n for r, n in zip(radii, padded)]
+    kernel[np.ix_(*idx)] = full
+    kfft = np.fft.rfftn(kernel).astype(np.complex64)
+    _fft_kernels[key] = kfft
+    while len(_fft_kernels) > FFT_KERNEL_CACHE_SIZE:
+        _fft_kernels.popitem(last=False)
+    return kfft, padded, radii
+
+def _fft_smooth(stack, sigmas):
+    """ fft convolution of each volume in stack with gaussian"""
+    single = stack.ndim == 3
+    if single:
+        stack = stack[None]
+    shape = stack.shape[1:]
+    kfft, padded, radii = fft_kernel(shape, sigmas)
+    out = np.empty(stack.shape, dtype=np.float32)
+    for ind in range(stack.shape[0]):
+        sm = np.fft.irfftn(np.fft.rfftn(stack[ind], padded) * kfft, padded)
+        out[ind] = sm[:shape[0], :shape[1], :shape[2]]
+    if single:
+        out = out[0]
+    return out
+
+def smooth_files(infiles, fwhm=8, prefix='s', method='separable'):
+    """ in process gaussian smoothing of infiles (fwhm in mm),
+    writes prefix + infile next to each file
+    returns list of smoothed files"""
+    outfiles = []
+    for infile in infiles:
+        img = nibabel.load(infile)
+        dat = np.nan_to_num(img.get_data())
+        if dat.ndim == 4:
+            # frames last in nifti, first in a stack
+            smoothed = np.rollaxis(smooth_stack(np.rollaxis(dat, 3),
+                                                img.get_affine(), fwhm,
+                                                method=method), 0, 4)
+        else:
+            smoothed = smooth_stack(dat, img.get_affine(), fwhm,
+                                    method=method)
+        outfile = prefix_filename(infile, prefix=prefix)
+        newimg = nibabel.Nifti1Image(smoothed, img.get_affine())
+        newimg.set_data_dtype(np.float32)
+        newimg.to_filename(outfile)
+        outfiles.append(outfile)
+    return outfiles
+
+
 def realigntoframe1(niftilist):
     """given list of nifti files
     copies relevent files to realign_QA
@@ -325,48 +706,185 @@ def touch_file(file):
     cout = cmd.run()
     return cout
 
-def clean_nan(niftilist):
-    """replaces nan in a file with zeros"""
-    newfiles = []
-    for item in niftilist:
-        newitem = prefix_filename(item, prefix='nonan-')
-        dat = nibabel.load(item).get_data().copy()
-        affine = nibabel.load(item).get_affine()
-        newdat = nan_to_num(dat)
-        hdr = nibabel.Nifti1Header()
-        newimg = nibabel.Nifti1Image(newdat, affine,hdr)
-        newimg.to_filename(newitem)
-        newfiles.append(newitem)
-    return newfiles
+class CleanFrames():
+    """ lazy NaN free view of a list of nifti frames, a frame is
+    loaded (and nan set to 0) only when it is used, so consumers
+    (qa.make_4d_nibabel, py_logan.load_masked_frames, make_mean)
+    can share it without nonan- copies being written
 
+    frames = CleanFrames(niftilist)
+    frames[0], len(frames), [x for x in frames]
+    frames.write() writes nonan- files (see clean_nan)
+    """
+    def __init__(self, niftilist):
+        self.files = [str(x) for x in niftilist]
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        dat = np.asarray(nibabel.load(self.files[index]).get_data())
+        if dat.dtype.kind == 'f':
+            # copy, never write nan to a memory mapped file
+            dat = nan_to_num(dat)
+        return dat
+
+    def __iter__(self):
+        for index in range(len(self.files)):
+            yield self[index]
+
+    def get_affine(self):
+        return nibabel.load(self.files[0]).get_affine()
+
+    def get_shape(self):
+        return nibabel.load(self.files[0]).get_shape()
+
+    def write(self, prefix='nonan-', nthreads=8):
+        """ writes prefix + file for every frame, in parallel,
+        skipping frames whose clean copy was already made from
+        the same content (md5 kept in the header description)
+        returns list of written files"""
+        return bg._pool_map(lambda x: _write_clean(x, prefix),
+                            self.files, nthreads)
+
+def file_md5(infile, blocksize=2**20):
+    """ md5 hex digest of the content of infile"""
+    md5 = hashlib.md5()
+    fid = open(infile, 'rb')
+    try:
+        block = fid.read(blocksize)
+        while block:
+            md5.update(block)
+            block = fid.read(blocksize)
+    finally:
+        fid.close()
+    return md5.hexdigest()
+
+def _write_clean(item, prefix='nonan-'):
+    """ writes NaN free copy of item unless an up to date one exists"""
+    newitem = prefix_filename(item, prefix=prefix)
+    descrip = 'nonan md5 %s'%(file_md5(item))
+    if os.path.isfile(newitem):
+        try:
+            current = str(nibabel.load(newitem).get_header()['descrip'])
+        except Exception:
+            current = None
+        if current is not None and descrip in current:
+            return newitem
+    img = nibabel.load(item)
+    newdat = nan_to_num(np.asarray(img.get_data()))
+    hdr = nibabel.Nifti1Header()
+    hdr['descrip'] = descrip
+    newimg = nibabel.Nifti1Image(newdat, img.get_affine(), hdr)
+    newimg.to_filename(newitem)
+    return newitem
+
+def nan_cleaned(niftilist):
+    """ lazy NaN free view of niftilist (see CleanFrames)"""
+    return CleanFrames(niftilist)
+
+def clean_nan(niftilist, nthreads=8):
+    """replaces nan in a file with zeros, writing nonan- copies
+    (in parallel, unchanged files are skipped)
+    use nan_cleaned for an in memory view when copies are not needed"""
+    return CleanFrames(niftilist).write(nthreads=nthreads)
 
 def make_summed_image(niftilist, prefix='sum_'):
     """given a list of nifti files
     generates a summed image"""
-    newfile = prefix_filename(niftilist[0], prefix=prefix)
-    affine = nibabel.load(niftilist[0]).get_affine()
-    shape =  nibabel.load(niftilist[0]).get_shape()
-    newdat = zeros(shape)
-    for item in niftilist:
-        newdat += nibabel.load(item).get_data().copy()
-    newimg = nibabel.Nifti1Image(newdat, affine)
-    newimg.to_filename(newfile)
-    return newfile
+    window = frame_window(1, len(niftilist), op='sum', prefix=prefix)
+    return reduce_frames(niftilist, [window], numbers=False)[0]
 
-def make_pons_normed(petf, maskf, outfile):
-    """given petf and maskf , normalize by mean of values
-    in mask and save to outfile"""
-    affine = nibabel.load(petf).get_affine()
-    pet = nibabel.load(petf).get_data().squeeze()
+def reference_value(dat, refdat, stat='mean', trim=0.1):
+    """ normalization constant of dat in reference region
+    (refdat > 0, dat > 0, finite)
+
+    stat : 'mean', 'median' or 'trimmed' (mean after dropping
+           trim fraction of voxels from each tail)
+    """
+    allmask = np.logical_and(refdat > 0, dat > 0)
+    allmask = np.logical_and(allmask, np.isfinite(dat))
+    if not allmask.any():
+        raise IOError('no voxels in reference region')
+    vals = dat[allmask].astype(np.float64)
+    if stat == 'mean':
+        return vals.mean()
+    if stat == 'median':
+        return np.median(vals)
+    if stat == 'trimmed':
+        if not 0 <= trim < 0.5:
+            raise AssertionError('trim must be in [0, 0.5), not %s'%trim)
+        vals.sort()
+        cut = int(trim * vals.shape[0])
+        return vals[cut:vals.shape[0] - cut].mean()
+    raise AssertionError('stat %s not mean, median or trimmed'%stat)
+
+def normalize_reference(petf, maskf, outfile, stat='mean', trim=0.1):
+    """ normalizes petf by the reference value (stat) of values in
+    maskf, saves float32 outfile and records the constant in a json
+    sidecar (see read_sidecar)
+    returns outfile, constant"""
+    img = nibabel.load(petf)
+    pet = np.asarray(img.get_data()).squeeze()
     mask = nibabel.load(maskf).get_data().squeeze()
     if not pet.shape == mask.shape:
-        raise AssertionError, 'pet and mask are different dimensions'
-    allmask = logical_and(pet> 0, mask> 0)
-    meanval = mean(pet[allmask])
-    normpet = pet / meanval
-    newimg = nibabel.Nifti1Image(normpet, affine)
+        raise AssertionError('pet and mask are different dimensions')
+    value = reference_value(pet, mask, stat, trim)
+    normpet = (pet / value).astype(np.float32)
+    newimg = nibabel.Nifti1Image(normpet, img.get_affine())
     newimg.to_filename(outfile)
+    write_sidecar(outfile, dict(source=os.path.abspath(petf),
+                                reference=os.path.abspath(maskf),
+                                stat=stat, trim=trim, value=value))
+    return outfile, value
+
+def renormalize_reference(normedf, maskf, outfile, stat='mean', trim=0.1):
+    """ normalizes an already normalized image (normedf, with the
+    sidecar from normalize_reference) to a different reference region
+    the raw scale comes from the recorded constant, so the source pet
+    is not needed; the new sidecar constant is on the raw scale
+    returns outfile, constant"""
+    info = read_sidecar(normedf)
+    if info is None or 'value' not in info:
+        raise IOError('no normalization sidecar for %s'%normedf)
+    img = nibabel.load(normedf)
+    normed = np.asarray(img.get_data()).squeeze()
+    mask = nibabel.load(maskf).get_data().squeeze()
+    if not normed.shape == mask.shape:
+        raise AssertionError('pet and mask are different dimensions')
+    # mean, median and trimmed mean scale with the data
+    value = info['value'] * reference_value(normed, mask, stat, trim)
+    scale = info['value'] / value
+    newimg = nibabel.Nifti1Image((normed * scale).astype(np.float32),
+                                 img.get_affine())
+    newimg.to_filename(outfile)
+    write_sidecar(outfile, dict(source=info.get('source', normedf),
+                                reference=os.path.abspath(maskf),
+                                stat=stat, trim=trim, value=value))
+    return outfile, value
+
+def _normalize_job(job):
+    """ runs normalize_reference on (petf, maskf, outfile), logs and
+    returns None on failure so one subject does not stop a batch"""
+    petf, maskf, outfile = job[:3]
+    try:
+        return normalize_reference(petf, maskf, outfile, *job[3:])
+    except (IOError, AssertionError) as e:
+        logging.error('%s not normalized: %s'%(petf, e))
+        return None
 
+def normalize_reference_batch(jobs, stat='mean', trim=0.1, nthreads=4):
+    """ runs normalize_reference across subjects in a thread pool
+    jobs is a list of (petf, maskf, outfile)
+    returns list of (outfile, constant), None for failed jobs"""
+    jobs = [tuple(x[:3]) + (stat, trim) for x in jobs]
+    return bg._pool_map(_normalize_job, jobs, nthreads)
+
+def make_pons_normed(petf, maskf, outfile, stat='mean'):
+    """given petf and maskf , normalize by mean of values
+    in mask and save to outfile (float32, constant in json sidecar)
+    see normalize_reference"""
+    return normalize_reference(petf, maskf, outfile, stat=stat)
 
 def simple_coregister(target, moving, other=None):
     """ uses the basic spm Coregister functionality to move the
@@ -428,25 +946,321 @@ def make_transform_name(inpet, inmri):
     newfile = os.path.join(pth, newnme)
     return newfile
 
-def make_mean_20min(niftilist):
+def frame_numbers(niftilist):
+    """ frame number of each file (from frameNN in the name),
+    position in list (starting at 1) if any file has no frame number
+    or numbers repeat"""
+    numbers = []
+    for item in niftilist:
+        m = re.search('frame0*([0-9]+)', os.path.split(item)[1])
+        if m is None:
+            return range(1, len(niftilist) + 1)
+        numbers.append(int(m.group(1)))
+    if len(set(numbers)) < len(numbers):
+        return range(1, len(niftilist) + 1)
+    return numbers
+
+def frame_window(start, end, op='mean', prefix=None):
+    """ window over frames start to end inclusive (frame numbers,
+    starting at 1) for reduce_frames
+    op is 'mean' or 'sum', prefix names the output file"""
+    if prefix is None:
+        prefix = '%s_frame%s_to_frame%s_'%(op, repr(start).zfill(2),
+                                           repr(end).zfill(2))
+    weights = dict([(x, 1.0) for x in range(start, end + 1)])
+    return {'prefix' : prefix, 'op' : op, 'weights' : weights}
+
+def minute_window(ftimes, start, end, op='mean', prefix=None,
+                  weighted=False):
+    """ window over the frames lying within start to end minutes,
+    using a frametimes array (see pyga/frametimes.py, rows of
+    frame, start, duration, stop in seconds) for reduce_frames
+
+    if weighted, frames are weighted by their seconds inside the
+    window (so a mean is the time average, and frames only partly
+    inside the window count for the part inside)
+    """
+    ftimes = np.asarray(ftimes)
+    if weighted:
+        overlap = np.minimum(ftimes[:,3], end * 60.) - \
+                  np.maximum(ftimes[:,1], start * 60.)
+        inside = overlap > 1e-3
+    else:
+        overlap = np.ones(ftimes.shape[0])
+        inside = np.logical_and(ftimes[:,1] >= start * 60. - 1e-3,
+                                ftimes[:,3] <= end * 60. + 1e-3)
+    if not inside.any():
+        raise IOError('no frames between %s and %s min'%(start, end))
+    if prefix is None:
+        prefix = '%s%s_%smin_'%(op, start, end)
+    weights = dict([(int(x), float(w)) for x, w in zip(ftimes[inside, 0],
+                                                       overlap[inside])])
+    return {'prefix' : prefix, 'op' : op, 'weights' : weights}
+
+def _accumulate(acc, comp, values):
+    """ adds values to acc in place, with kahan compensation
+    if comp is not None"""
+    if comp is None:
+        acc += values
+        return
+    y = values - comp
+    t = acc + y
+    comp[:] = (t - acc) - y
+    acc[:] = t
+
+def accumulate_windows(niftilist, windows, kahan=False, numbers=True):
+    """ reads each frame once and accumulates every window in windows
+    (from frame_window / minute_window)
+
+    Parameters
+    ----------
+    niftilist : list of 3D frame files (or a CleanFrames view)
+    windows : list of window dicts (prefix, op, weights)
+    kahan : use compensated (kahan) summation in the float32
+            accumulators
+    numbers : frames are identified by frameNN in the filenames,
+              if False by position in niftilist (starting at 1)
+
+    Returns
+    -------
+    results : list of float32 arrays, one per window
+    affine : affine of the frames
+    firstframes : first frame file of each window
+    """
+    frames = None
+    if isinstance(niftilist, CleanFrames):
+        frames = niftilist
+        niftilist = frames.files
+    if numbers:
+        framen = frame_numbers(niftilist)
+    else:
+        framen = range(1, len(niftilist) + 1)
+    byframe = dict(zip(framen, niftilist))
+    for window in windows:
+        missing = [x for x in window['weights'] if not x in byframe]
+        if len(missing) > 0:
+            raise IOError('frames %s missing for %s'%(missing,
+                                                      window['prefix']))
+    img = nibabel.load(niftilist[0])
+    affine = img.get_affine()
+    shape = img.get_shape()
+    accs = [zeros(shape, dtype=np.float32) for x in windows]
+    if kahan:
+        comps = [zeros(shape, dtype=np.float32) for x in windows]
+    else:
+        comps = [None for x in windows]
+    for pos, (frame, item) in enumerate(zip(framen, niftilist)):
+        users = [val for val, x in enumerate(windows) if frame in x['weights']]
+        if len(users) < 1:
+            continue
+        if frames is None:
+            dat = nibabel.load(item).get_data()
+        else:
+            dat = frames[pos]
+        dat = np.asarray(dat, dtype=np.float32)
+        for val in users:
+            weight = windows[val]['weights'][frame]
+            if weight == 1:
+                _accumulate(accs[val], comps[val], dat)
+            else:
+                _accumulate(accs[val], comps[val],
+                            dat * np.float32(weight))
+    for window, acc in zip(windows, accs):
+        if window['op'] == 'mean':
+            acc /= np.float32(sum(window['weights'].values()))
+    firstframes = [byframe[min(x['weights'])] for x in windows]
+    return accs, affine, firstframes
+
+def reduce_frames(niftilist, windows, kahan=False, numbers=True):
+    """ reads each frame once and accumulates every window in windows
+    (see accumulate_windows), writing one image per window,
+    prefix + first frame of the window, next to that frame
+
+    Returns
+    -------
+    outfiles : list, one file per window
+    """
+    accs, affine, firstframes = accumulate_windows(niftilist, windows,
+                                                   kahan=kahan,
+                                                   numbers=numbers)
+    outfiles = []
+    for window, acc, first in zip(windows, accs, firstframes):
+        newfile = prefix_filename(first, prefix=window['prefix'])
+        newimg = nibabel.Nifti1Image(acc, affine)
+        newimg.to_filename(newfile)
+        outfiles.append(newfile)
+    return outfiles
+
+def make_mean_windows(niftilist, windows, kahan=False):
+    """ means/sums of several frame windows in one pass over
+    niftilist (see reduce_frames), returns files or None on
+    missing frames"""
+    try:
+        return reduce_frames(niftilist, windows, kahan=kahan)
+    except IOError as e:
+        print 'unable to generate %s: %s'%(
+            ', '.join([x['prefix'] for x in windows]), e)
+        return None
+
+def _import_frametimes():
+    """ imports pyga/frametimes.py when first needed, it needs
+    pydicom which most users of this module do not"""
+    pygadir = '/home/jagust/cindeem/CODE/PetProcessing/pyga'
+    if not pygadir in sys.path:
+        sys.path.insert(0, pygadir)
+    import frametimes
+    return frametimes
+
+def read_sidecar(outfile):
+    """ reads the json sidecar (outfile base + .json) written with an
+    output, returns dict or None if missing"""
+    sidecar = os.path.splitext(outfile.replace('.gz', ''))[0] + '.json'
+    if not os.path.isfile(sidecar):
+        return None
+    fid = open(sidecar)
+    try:
+        return json.load(fid)
+    except ValueError:
+        return None
+    finally:
+        fid.close()
+
+def write_sidecar(outfile, info):
+    """ writes info (dict) to json sidecar of outfile"""
+    sidecar = os.path.splitext(outfile.replace('.gz', ''))[0] + '.json'
+    fid = open(sidecar, 'w')
+    json.dump(info, fid, indent=1, sort_keys=True)
+    fid.close()
+    return sidecar
+
+def _is_current(outfile, inputs, info):
+    """ checks a cached output is newer than its inputs and was
+    made from the same inputs and settings"""
+    if not os.path.isfile(outfile):
+        return False
+    cached = read_sidecar(outfile)
+    if cached is None:
+        return False
+    for key in info:
+        if not cached.get(key) == info[key]:
+            return False
+    newest = max([os.path.getmtime(x) for x in inputs])
+    return os.path.getmtime(outfile) >= newest
+
+def reference_mean(dat, refdat):
+    """ mean of dat in reference region (refdat > 0, dat > 0, finite)"""
+    return reference_value(dat, refdat, 'mean')
+
+def make_suvr_windows(niftilist, ftimes, windows, refroi, outdir=None,
+                      kahan=False, force=False):
+    """ SUVR images for minute windows, frames are mapped to windows
+    with the frametimes (partial frames weighted by their seconds
+    inside the window), all windows come from one pass over the frames
+    and are normalized by the mean of refroi
+
+    results are cached on disk per subject (outdir), window and
+    reference: an existing SUVR newer than its inputs, made from the
+    same frames and weights, is reused unless force is True
+
+    Parameters
+    ----------
+    niftilist : list of 3D frame files (frameNN in the names)
+    ftimes : frametimes array or frametimes file (pyga/frametimes.py)
+    windows : list of (start, end) in minutes
+    refroi : reference region mask file, on the frame grid
+    outdir : directory for outputs (default directory of first frame)
+
+    Returns
+    -------
+    results : list of (suvr file, reference mean) per window
+    """
+    timing = ftimes
+    if not hasattr(ftimes, 'shape'):
+        frametimes = _import_frametimes()
+        timing = frametimes.load_frametimes(ftimes)
+    if outdir is None:
+        outdir, _ = os.path.split(os.path.abspath(niftilist[0]))
+    refbase = os.path.split(refroi)[1].split('.')[0]
+    inputs = list(niftilist) + [refroi]
+    if not hasattr(ftimes, 'shape'):
+        inputs.append(ftimes)
+    results = [None for x in windows]
+    todo = []
+    for val, (start, end) in enumerate(windows):
+        window = minute_window(timing, start, end, weighted=True,
+                               prefix='suvr%s_%smin_%s_'%(start, end,
+                                                          refbase))
+        info = {'reference' : os.path.abspath(refroi),
+                'window' : [start, end],
+                'weights' : sorted([[k, v] for k, v in
+                                    window['weights'].items()]),
+                'frames' : [os.path.abspath(x) for x in niftilist]}
+        outfile = os.path.join(outdir, '%s%s'%(window['prefix'],
+                                               os.path.split(niftilist[0])[1]))
+        cached = read_sidecar(outfile)
+        if not force and _is_current(outfile, inputs, info):
+            results[val] = (outfile, cached['refmean'])
+        else:
+            todo.append((val, window, info, outfile))
+    if len(todo) < 1:
+        return results
+    accs, affine, _ = accumulate_windows(niftilist, [x[1] for x in todo],
+                                         kahan=kahan)
+    refdat = nibabel.load(refroi).get_data()
+    refdat = refdat.reshape(refdat.shape[:3])
+    for (val, window, info, outfile), acc in zip(todo, accs):
+        acc = acc.reshape(acc.shape[:3])
+        if not refdat.shape == acc.shape:
+            raise IOError('reference %s and frames are different '\
+                          'dimensions'%(refroi))
+        refmean = reference_mean(acc, refdat)
+        acc /= np.float32(refmean)
+        newimg = nibabel.Nifti1Image(acc, affine)
+        newimg.to_filename(outfile)
+        info['refmean'] = refmean
+        write_sidecar(outfile, info)
+        results[val] = (outfile, refmean)
+    return results
+
+
+def make_mean_minutes(niftilist, ftimes, start, end, prefix):
+    """ time weighted mean image of start to end minutes, frames picked
+    with frametimes (array or file), see minute_window"""
+    if not hasattr(ftimes, 'shape'):
+        frametimes = _import_frametimes()
+        ftimes = frametimes.load_frametimes(ftimes)
+    try:
+        window = minute_window(ftimes, start, end, prefix=prefix,
+                               weighted=True)
+        return reduce_frames(niftilist, [window])[0]
+    except IOError as e:
+        print 'unable to generate %s-%s min mean: %s'%(start, end, e)
+        return None
+
+def make_mean_20min(niftilist, ftimes=None):
     """given list of niftis, grab frame 1-23
-    generate mean image"""
+    generate mean image
+    (if frametimes are given, frames in the first 20 minutes)"""
+    if ftimes is not None:
+        return make_mean_minutes(niftilist, ftimes, 0, 20, 'mean20min_')
     first_23 = niftilist[:23]
     first_23.sort()
     if not '23' in first_23[-1]:
         print "badframe numbers, unable to generate 20min mean"
         print 'frames', first_23
         return None
-    newfile = make_mean(first_23, prefix='mean20min_')
-    return newfile
+    window = frame_window(1, 23, prefix='mean20min_')
+    return reduce_frames(first_23, [window], numbers=False)[0]
 
-def make_mean_40_60(niftilist):
+def make_mean_40_60(niftilist, ftimes=None):
     """given list of niftis, grab frame 28-31
-    generate mean image"""
+    generate mean image
+    (if frametimes are given, frames in 40 to 60 minutes)"""
+    if ftimes is not None:
+        return make_mean_minutes(niftilist, ftimes, 40, 60, 'mean40_60min_')
     #framen = [28,29,30,31]
-    try:
-        frames_28_31 = niftilist[27:31] #note frames start counting from 1
-    except:
+    frames_28_31 = niftilist[27:31] #note frames start counting from 1
+    if len(frames_28_31) < 4:
         print 'incorrect number of frames for making sum_40_60'
         return None
     m = re.search('frame0*28.nii',frames_28_31[0])
@@ -454,156 +1268,273 @@ def make_mean_40_60(niftilist):
         print 'bad frame numbers, unable to generate 40-60 mean'
         print 'frames', frames_28_31
         return None
-    newfile = make_mean(frames_28_31, prefix='mean40_60min_')
-    return newfile
+    window = frame_window(28, 31, prefix='mean40_60min_')
+    try:
+        return reduce_frames(frames_28_31, [window])[0]
+    except IOError as e:
+        print 'unable to generate 40-60 mean: %s'%(e)
+        return None
 
 
 def make_mean_usrdefined(niftilist, start, end):
     """ given nifti list generate mean image from
     start frame<start> to end frame<end>  inclusive
     name based on start and end frame numbers
-    error raise if frame numbers not found in niftilist
-    no check for missing frames between start and end"""
+    returns None if frames are not found in niftilist"""
     niftilist.sort()
-    # find indicies for the start and end frames in list
-    for val, item in enumerate(niftilist):
-        if 'frame' + repr(start).zfill(2) in item:
-            start_frame = val
-        if 'frame' + repr(end).zfill(2) in item:
-            end_frame = val + 1 #add one to make sure we include frame
-    frames = niftilist[start_frame:end_frame]
     prefix = 'mean_frame' + repr(start).zfill(2) + \
              '_to_frame' +repr(end).zfill(2) + '_'
-    newfile = make_mean(frames, prefix = prefix)
-    return newfile
+    window = frame_window(start, end, prefix=prefix)
+    try:
+        return reduce_frames(niftilist, [window])[0]
+    except IOError as e:
+        print 'unable to generate frame %d to %d mean: %s'%(start, end, e)
+        return None
 
 
 def make_mean(niftilist, prefix='mean_'):
     """given a list of nifti files
     generates a mean image"""
-    n_images = len(niftilist)
-    newfile = prefix_filename(niftilist[0], prefix=prefix)
-    affine = nibabel.load(niftilist[0]).get_affine()
-    shape =  nibabel.load(niftilist[0]).get_shape()
-    newdat = zeros(shape)
-    for item in niftilist:
-        newdat += nibabel.load(item).get_data().copy()
-    newdat = newdat / n_images
-    newimg = nibabel.Nifti1Image(newdat, affine)
-    newimg.to_filename(newfile)
-    return newfile
+    window = frame_window(1, len(niftilist), prefix=prefix)
+    return reduce_frames(niftilist, [window], numbers=False)[0]
+
+def rigid_matrix(x):
+    """ 4x4 rigid body matrix from x = (tx, ty, tz) in mm and
+    (pitch, roll, yaw) in radians, as spm_matrix"""
+    tx, ty, tz, rx, ry, rz = [float(v) for v in x[:6]]
+    T = np.array([[1, 0, 0, tx],
+                  [0, 1, 0, ty],
+                  [0, 0, 1, tz],
+                  [0, 0, 0, 1]])
+    R1 = np.array([[1, 0, 0, 0],
+                   [0, np.cos(rx), np.sin(rx), 0],
+                   [0, -np.sin(rx), np.cos(rx), 0],
+                   [0, 0, 0, 1]])
+    R2 = np.array([[np.cos(ry), 0, np.sin(ry), 0],
+                   [0, 1, 0, 0],
+                   [-np.sin(ry), 0, np.cos(ry), 0],
+                   [0, 0, 0, 1]])
+    R3 = np.array([[np.cos(rz), np.sin(rz), 0, 0],
+                   [-np.sin(rz), np.cos(rz), 0, 0],
+                   [0, 0, 1, 0],
+                   [0, 0, 0, 1]])
+    return dot(T, dot(R1, dot(R2, R3)))
+
+def _histogram_scale(dat, bins=256):
+    """ scales dat to [0, bins - 1] (top 0.1% clipped), non finite
+    values set to 0"""
+    dat = np.asarray(dat, dtype=np.float32)
+    finite = np.isfinite(dat)
+    if not finite.any():
+        raise IOError('no finite values to register')
+    lo = dat[finite].min()
+    hi = np.percentile(dat[finite], 99.9)
+    if not hi > lo:
+        hi = dat[finite].max()
+    if not hi > lo:
+        raise IOError('constant image, unable to register')
+    scaled = (np.where(finite, dat, lo) - lo) * ((bins - 1) / (hi - lo))
+    return np.clip(scaled, 0, bins - 1).astype(np.float32)
+
+def joint_histogram(a, b, bins=256, fwhm=(7, 7)):
+    """ joint histogram of a and b (values in [0, bins - 1]),
+    smoothed by fwhm (in bins) as spm_coreg"""
+    index = a.astype(np.intp) * bins + b.astype(np.intp)
+    hist = np.bincount(index, minlength=bins * bins).astype(np.float64)
+    hist = hist.reshape((bins, bins))
+    for axis, width in enumerate(fwhm):
+        if width > 0:
+            hist = gaussian_filter1d(hist, width / np.sqrt(8 * np.log(2)),
+                                     axis=axis, mode='constant')
+    return hist
+
+def normalized_mutual_information(hist):
+    """ (H(a) + H(b)) / H(a, b) of a joint histogram"""
+    hist = hist / hist.sum() + np.finfo(np.float64).eps
+    hist = hist / hist.sum()
+    pa = hist.sum(axis=1)
+    pb = hist.sum(axis=0)
+    ha = -(pa * np.log(pa)).sum()
+    hb = -(pb * np.log(pb)).sum()
+    hab = -(hist * np.log(hist)).sum()
+    return (ha + hb) / hab
+
+def _nmi_cost(x, points, tvals, movdat, movinv, tgtaffine, bins, fwhm):
+    """ -NMI of target samples and moving image under rigid x"""
+    xform = dot(movinv, dot(rigid_matrix(x), tgtaffine))
+    coords = dot(xform[:3,:3], points) + xform[:3,3:]
+    upper = (np.array(movdat.shape) - 1).reshape((3,1))
+    inside = np.logical_and(coords >= 0, coords <= upper).all(axis=0)
+    if inside.sum() < 32:
+        # no overlap, worse than any real alignment
+        return 0.
+    mvals = map_coordinates(movdat, coords[:, inside], order=1)
+    hist = joint_histogram(tvals[inside], mvals, bins, fwhm)
+    return -normalized_mutual_information(hist)
+
+def rigid_coreg(target, moving, sep=(4, 2), step=None, xtol=0.01,
+                ftol=1e-5, fwhm=(7, 7), bins=256, x0=None):
+    """ rigid body registration of moving to target maximizing
+    normalized mutual information, in process (numpy / scipy), as
+    spm_coreg(target, moving)
+
+    images are sampled every sep mm (one level per sep, coarse to
+    fine, each starting from the last), smoothed to the sampling
+    distance, and parameters found by powell search
+    numerical failures (eg no overlap, singular affines) are raised
+    as IOError, so batch callers skip the subject
+
+    Parameters
+    ----------
+    target : file of image to stay fixed (eg pet)
+    moving : file of image to align (eg mri)
+    sep : sampling distances in mm (coarse to fine)
+    step : initial powell step of each parameter (3 mm, 3 radians),
+           default 0.4 mm, 0.02 radians
+    xtol : line search tolerance (see scipy.optimize.fmin_powell)
+    ftol : stop when a powell iteration improves -NMI by less
+           than this (relative)
+    fwhm : smoothing of joint histogram in bins
+    bins : histogram bins
+    x0 : starting parameters (default 0, images aligned by headers)
+
+    Returns
+    -------
+    x : 6 rigid parameters (see rigid_matrix), moving is in register
+        with target at dot(inv(rigid_matrix(x)), moving affine)
+    """
+    if step is None:
+        step = [0.4, 0.4, 0.4, 0.02, 0.02, 0.02]
+    tgtimg = nibabel.load(target)
+    tgtaffine = tgtimg.get_affine()
+    tgtdat = _histogram_scale(np.asarray(tgtimg.get_data()).squeeze(), bins)
+    movimg = nibabel.load(moving)
+    movaffine = movimg.get_affine()
+    movdat = _histogram_scale(np.asarray(movimg.get_data()).squeeze(), bins)
+    if not tgtdat.ndim == 3 or not movdat.ndim == 3:
+        raise IOError('%s and %s need to be 3D'%(target, moving))
+    if x0 is None:
+        x = np.zeros(6)
+    else:
+        x = np.asarray(x0, dtype=np.float64)
+    try:
+        x = _rigid_search(tgtdat, tgtaffine, movdat, movaffine, x, sep,
+                          step, xtol, ftol, fwhm, bins)
+    except (ValueError, FloatingPointError, np.linalg.LinAlgError) as e:
+        raise IOError('registration of %s to %s failed: %s'%(moving,
+                                                           target, e))
+    if not np.isfinite(x).all():
+        raise IOError('registration of %s to %s failed: %s'%(moving,
+                                                           target, x))
+    return x
+
+def _rigid_search(tgtdat, tgtaffine, movdat, movaffine, x, sep, step,
+                  xtol, ftol, fwhm, bins):
+    """ multi resolution powell search of rigid_coreg"""
+    movinv = np.linalg.inv(movaffine)
+    tgtvox = np.sqrt((tgtaffine[:3,:3]**2).sum(axis=0))
+    movvox = np.sqrt((movaffine[:3,:3]**2).sum(axis=0))
+    direc = np.diag(np.asarray(step, dtype=np.float64))
+    # fixed jitter of the sample grid (reduces interpolation artifacts)
+    rand = np.random.RandomState(0)
+    for sampling in sep:
+        # smooth to sampling distance
+        tgtfwhm = np.sqrt(np.maximum(sampling**2 - tgtvox**2, 0))
+        movfwhm = np.sqrt(np.maximum(sampling**2 - movvox**2, 0))
+        tgtsmooth = smooth_stack(tgtdat, tgtaffine, tgtfwhm)
+        movsmooth = smooth_stack(movdat, movaffine, movfwhm)
+        stride = np.maximum(sampling / tgtvox, 1)
+        grid = np.mgrid[0:tgtdat.shape[0] - 1:stride[0],
+                        0:tgtdat.shape[1] - 1:stride[1],
+                        0:tgtdat.shape[2] - 1:stride[2]]
+        points = grid.reshape((3, -1))
+        points = points + rand.uniform(0, 1, points.shape) * \
+                 stride.reshape((3,1))
+        upper = (np.array(tgtdat.shape) - 1).reshape((3,1))
+        points = np.minimum(points, upper)
+        tvals = map_coordinates(tgtsmooth, points, order=1)
+        x = scipy.optimize.fmin_powell(_nmi_cost, x,
+                                       args=(points, tvals, movsmooth,
+                                             movinv, tgtaffine, bins, fwhm),
+                                       direc=direc, xtol=xtol, ftol=ftol,
+                                       disp=0)
+        x = np.atleast_1d(x)
+    return x
+
+def save_transform(M, transform):
+    """ saves 4x4 M to spm style .mat file (see load_transform)"""
+    scipy.io.savemat(transform, {'M': np.asarray(M, dtype=np.float64)})
+    return transform
 
-    
 def invert_coreg(mri, pet, transform):
     """ coregisters pet to mri, inverts parameters
-    and applies to mri"""
-    startdir = os.getcwd()
-    pth, _ = os.path.split(pet)
-    os.chdir(pth)
-    mlab_cmd = mlab.MatlabCommand(matlab_cmd='matlab-spm8')
-    mlab_cmd.inputs.nodesktop = True
-    mlab_cmd.inputs.nosplash = True
-    mlab_cmd.inputs.mfile = True
-    mlab_cmd.inputs.script_file = 'pyspm8_invert_coreg.m'
-    script = """
-    pet = \'%s\';
-    mri = \'%s\';
-    petv = spm_vol(pet);
-    mriv = spm_vol(mri);
-    x = spm_coreg(petv, mriv);
-    M = inv(spm_matrix(x(:)'));
-    save( \'%s\' , \'M\' );
-    mrispace = spm_get_space(mri);
-    spm_get_space(mri, M*mrispace);
-    """%(pet,
-         mri,
-         transform)
-    mlab_cmd.inputs.script = script
-    mout = mlab_cmd.run()
-    os.chdir(startdir)
-    return mout
+    and applies to mri (rigid_coreg, no matlab), saves M in transform
+    returns transform"""
+    x = rigid_coreg(pet, mri)
+    M = np.linalg.inv(rigid_matrix(x))
+    save_transform(M, transform)
+    set_space(mri, dot(M, nibabel.load(mri).get_affine()))
+    return transform
 
 def forward_coreg(mri, pet, transform):
-    """ coregisters pet to mri and applies to pet,
-    saves parameters in transform """
-    startdir = os.getcwd()
-    pth, _ = os.path.split(pet)
-    os.chdir(pth)
-    mlab_cmd = mlab.MatlabCommand(matlab_cmd='matlab-spm8')
-    mlab_cmd.inputs.nodesktop = True
-    mlab_cmd.inputs.nosplash = True
-    mlab_cmd.inputs.mfile = True
-    mlab_cmd.inputs.script_file = 'pyspm8_invert_coreg.m'
-    script = """
-    pet = \'%s\';
-    mri = \'%s\';
-    petv = spm_vol(pet);
-    mriv = spm_vol(mri);
-    x = spm_coreg(petv, mriv);
-    M = spm_matrix(x(:)');
-    save( \'%s\' , \'M\' );
-    petspace = spm_get_space(pet);
-    spm_get_space(pet, M * petspace);
-    """%(pet,
-         mri,
-         transform)
-    mlab_cmd.inputs.script = script
-    mout = mlab_cmd.run()
-    os.chdir(startdir)
-    return mout
-    
-    
+    """ coregisters pet to mri and applies to pet (rigid_coreg,
+    no matlab), saves parameters in transform
+    returns transform"""
+    x = rigid_coreg(pet, mri)
+    M = rigid_matrix(x)
+    save_transform(M, transform)
+    set_space(pet, dot(M, nibabel.load(pet).get_affine()))
+    return transform
+
+def _coreg_job(job):
+    """ runs invert_coreg or forward_coreg on (mri, pet, transform,
+    direction), returns transform, or None (logged) on failure"""
+    mri, pet, transform, direction = job
+    try:
+        if direction == 'forward':
+            return forward_coreg(mri, pet, transform)
+        return invert_coreg(mri, pet, transform)
+    except (IOError, AssertionError, ValueError) as e:
+        logging.error('coreg %s %s failed: %s'%(mri, pet, e))
+        return None
 
+def coreg_batch(jobs, direction='invert', nprocs=None):
+    """ runs coregistrations across subjects in a process pool
+    jobs is a list of (mri, pet, transform)
+    direction : 'invert' (move mri) or 'forward' (move pet)
+    nprocs : number of worker processes (default all cpus)
+    returns list of transforms, None for failed jobs"""
+    if not direction in ('invert', 'forward'):
+        raise AssertionError('direction %s not invert or forward'%direction)
+    jobs = [tuple(x[:3]) + (direction,) for x in jobs]
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    nprocs = max(1, min(nprocs, len(jobs)))
+    if nprocs < 2:
+        return [_coreg_job(x) for x in jobs]
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        result = pool.map(_coreg_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return result
 
 def apply_transform_onefile(transform,file):
-    """ applies transform to files using spm """
-    startdir = os.getcwd()
-    pth, _ = os.path.split(file)
-    os.chdir(pth)
-    mlab_cmd = mlab.MatlabCommand(matlab_cmd = 'matlab-spm8')
-    mlab_cmd.inputs.nodesktop = True
-    mlab_cmd.inputs.nosplash = True
-    mlab_cmd.inputs.ignore_exception = True
-    mlab_cmd.inputs.mfile = True
-    mlab_cmd.inputs.script_file = 'pyspm8_apply_transform.m'
-    script = """
-    infile = \'%s\';
-    transform = load(\'%s\');
-    imgspace = spm_get_space(infile);
-    spm_get_space(infile ,transform.M*imgspace);
-    """%(file, transform)
-    mlab_cmd.inputs.script = script
-    mout = mlab_cmd.run()
-    os.chdir(startdir)
-    return mout
-    
-
-def reslice(space_define, infile):
-    """ uses spm_reslice to resample infile into the space
-    of space_define, assumes they are already in register"""
-    startdir = os.getcwd()
-    pth, _ = os.path.split(infile)
-    os.chdir(pth)
-    mlab_cmd = mlab.MatlabCommand(matlab_cmd = 'matlab-spm8')
-    mlab_cmd.inputs.nodesktop = True
-    mlab_cmd.inputs.nosplash = True
-    mlab_cmd.inputs.mfile = True
-    mlab_cmd.inputs.ignore_exception = True
-    mlab_cmd.inputs.script_file = 'pyspm8_reslice.m'
-    script = """
-    flags.mean = 0;
-    flags.which = 1;
-    flags.mask = 1;
-    flags.interp = 0;
-    infiles = strvcat(\'%s\', \'%s\');
-    invols = spm_vol(infiles);
-    spm_reslice(invols, flags);
-    """%(space_define, infile)
-    mlab_cmd.inputs.script = script
-    mout = mlab_cmd.run()
-    os.chdir(startdir)
-    return mout
-
+    """ applies transform (spm .mat with 4x4 M) to the
+    space of file, header only, data is not resampled
+    returns file"""
+    M = load_transform(transform)
+    affine = nibabel.load(file).get_affine()
+    return set_space(file, dot(M, affine))
+
+def reslice(space_define, infile, interp='nearest'):
+    """ resamples infile into the space of space_define,
+    assumes they are already in register, writes r<infile>
+    (nearest neighbour, outside of infile is 0, as spm_reslice
+    with interp 0, mask 1)
+    returns resliced file"""
+    return reslice_files(space_define, [infile], interp=interp)[0]
 
 def find_single_file(searchstring):
     """ glob for single file using searchstring
@@ -887,28 +1818,130 @@ def roilabels_fromcsv(infile):
         roid[roi] = np.array(labels, dtype=int)
     return roid
 
+def label_lut(classes, maxlabel, dtype=np.uint8):
+    """ builds a lookup array indexed by label value
+
+    Parameters
+    ----------
+    classes : list of label sets, voxels with a label in set i get
+              class i + 1 (later sets win where sets overlap)
+              a set may hold labels and (low, high) inclusive ranges
+    maxlabel : largest label to cover
+
+    Returns
+    -------
+    lut : array (maxlabel + 1,) label -> class (0 is no class)
+    """
+    lut = np.zeros(int(maxlabel) + 1, dtype=dtype)
+    for val, labels in enumerate(classes):
+        for label in labels:
+            if hasattr(label, '__iter__'):
+                low, high = label
+                lut[max(int(low), 0):int(high) + 1] = val + 1
+            elif 0 <= label <= maxlabel:
+                lut[int(label)] = val + 1
+    return lut
+
+def classify_labels(labeldat, classes, dtype=np.uint8):
+    """ maps a label image (eg aparc_aseg data) through a label lut
+    (see label_lut) in one pass, returns integer class image
+    (0 where a voxel is in none of the classes)"""
+    labeldat = np.asarray(labeldat)
+    if labeldat.dtype.kind == 'f':
+        labeldat = np.round(labeldat)
+    labeldat = labeldat.astype(np.int64)
+    maxlabel = max(labeldat.max(), 0) if labeldat.size else 0
+    lut = label_lut(classes, maxlabel, dtype=dtype)
+    # negative labels map to 0
+    return np.where(labeldat < 0, 0, lut.take(labeldat.clip(0, maxlabel)))
+
+
+def label_stats(labels, data, othermask=None):
+    """ computes count, sum, sum of squares, min and max of data
+    for every label in labels, in one pass over the volume
+    only voxels with data > 0, finite (and othermask > 0) are used
+
+    Parameters
+    ----------
+    labels : array of integer labels (eg aparc_aseg), same shape as data
+    data : array of data values
+    othermask : array or file, if not None only voxels > 0 are used
+
+    Returns
+    -------
+    stats : dict of arrays, one entry per label found
+            'label', 'count', 'sum', 'sumsq', 'min', 'max'
+    """
+    if not labels.shape == data.shape:
+        raise IOError('shape mismatch of labels %s and data %s'%(labels.shape,
+                                                               data.shape))
+    valid = np.logical_and(data > 0, np.isfinite(data))
+    if othermask is not None:
+        if not hasattr(othermask, 'shape'):
+            othermask = nibabel.load(othermask).get_data()
+        if not othermask.shape == data.shape:
+            raise IOError('shape mismatch of DATA and othermask')
+        valid = np.logical_and(valid, othermask > 0)
+    vals = data[valid].astype(np.float64)
+    # round, as in classify_labels, resliced or scaled labels
+    # are not exact integers
+    ids, inv = np.unique(np.round(labels[valid]).astype(int),
+                         return_inverse=True)
+    nlabels = ids.shape[0]
+    count = np.bincount(inv, minlength=nlabels)
+    stats = {'label' : ids,
+             'count' : count,
+             'sum' : np.bincount(inv, weights=vals, minlength=nlabels),
+             'sumsq' : np.bincount(inv, weights=vals**2, minlength=nlabels)}
+    if nlabels > 0:
+        # group values by label, min/max over each group
+        sorted_vals = vals[np.argsort(inv, kind='mergesort')]
+        starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+        stats['min'] = np.minimum.reduceat(sorted_vals, starts)
+        stats['max'] = np.maximum.reduceat(sorted_vals, starts)
+    else:
+        stats['min'] = np.zeros(0)
+        stats['max'] = np.zeros(0)
+    return stats
+
+
+def stats_from_labels(stats, label_ids):
+    """ aggregates per label stats (from label_stats) over the
+    labels in label_ids, returns dict of
+    'mean', 'std', 'nvox', 'min', 'max' (mean etc are nan if no voxels)
+    """
+    inroi = np.in1d(stats['label'], np.asarray(label_ids, dtype=int))
+    nvox = stats['count'][inroi].sum()
+    if nvox == 0:
+        return dict(mean=np.nan, std=np.nan, nvox=0,
+                    min=np.nan, max=np.nan)
+    mean = stats['sum'][inroi].sum() / nvox
+    var = max(stats['sumsq'][inroi].sum() / nvox - mean**2, 0.0)
+    return dict(mean=mean, std=np.sqrt(var), nvox=int(nvox),
+                min=stats['min'][inroi].min(), max=stats['max'][inroi].max())
+
+
 def mean_from_labels(roid, labelimg, data, othermask = None):
+    """ given dict of roi -> label values (see roilabels_fromcsv)
+    returns dict of roi -> [mean, nvox] of data in the union of each roi
+    labels (data > 0, finite, and othermask > 0 if given)
+    'ALL' holds the values of all rois combined
+    label stats are computed once and aggregated per roi"""
     meand = {}
     labels = nibabel.load(labelimg).get_data()
     if not labels.shape == data.shape:
         return None
-    allmask = np.zeros(labels.shape, dtype=bool)
+    stats = label_stats(labels, data, othermask=othermask)
+    all_labels = []
     for roi, mask in roid.items():
-        fullmask = np.zeros(labels.shape, dtype=bool)
-        for label_id in mask:
-            fullmask = np.logical_or(fullmask, labels == label_id)
-            data_mask = np.logical_and(data>0, np.isfinite(data))
-            fullmask = np.logical_and(fullmask, data_mask)
-            if othermask is not None:
-                maskdat = nibabel.load(othermask).get_data()
-                fullmask = np.logical_and(fullmask, maskdat > 0)
-            # update allmask
-            allmask = np.logical_or(allmask, fullmask)
-            roimean = data[fullmask].mean()
-            roinvox = data[fullmask].shape[0]
-            meand[roi] = [roimean, roinvox]
+        if len(mask) < 1:
+            continue
+        roistats = stats_from_labels(stats, mask)
+        meand[roi] = [roistats['mean'], roistats['nvox']]
+        all_labels.extend(mask)
     # get values of all regions
-    meand['ALL'] = [data[allmask].mean(), data[allmask].shape[0]]
+    allstats = stats_from_labels(stats, all_labels)
+    meand['ALL'] = [allstats['mean'], allstats['nvox']]
     return meand
 
 def mean_from_labels_percent(roid, labelimg, data, percent = .50):
@@ -952,6 +1985,275 @@ def meand_to_file(meand, csvfile):
     
 if __name__ == '__main__':
 
+	## resample plans against scipy.ndimage.affine_transform
+	rand = np.random.RandomState(0)
+	src = rand.uniform(0, 100, (20, 22, 18))
+	src_affine = np.diag([2., 2., 2.4, 1.])
+	target_affine = np.array([[1.5, -0.15, 0, 2.31],
+				  [0.15, 1.5, 0, -1.73],
+				  [0, 0, 1.8, 0.97],
+				  [0, 0, 0, 1]])
+	target_shape = (26, 30, 26)
+	Tv = dot(np.linalg.inv(src_affine), target_affine)
+	for interp, order in [('nearest', 0), ('linear', 1)]:
+		plan = ResamplePlan(src_affine, src.shape, target_affine,
+				    target_shape, interp=interp)
+		valid = plan.valid.reshape(target_shape)
+		assert valid.any() and not valid.all()
+		expected = affine_transform(src, Tv[:3,:3], offset=Tv[:3,3],
+					    output_shape=target_shape,
+					    order=order, mode='nearest')
+		result = plan.apply(src)
+		np.testing.assert_almost_equal(result[valid], expected[valid],
+					       decimal=3)
+		np.testing.assert_equal(result[~valid], 0)
+	## spm_reslice mask, inside up to tiny voxels past the edges
+	plan = ResamplePlan(np.eye(4), (4, 4, 4), np.eye(4), (6, 4, 4))
+	edge = np.eye(4)
+	edge[0, 3] = 0.04
+	plan_edge = ResamplePlan(np.eye(4), (4, 4, 4), edge, (4, 4, 4))
+	assert plan.valid.reshape((6, 4, 4))[:4].all()
+	assert not plan.valid.reshape((6, 4, 4))[4:].any()
+	assert plan_edge.valid.all()
+	## reslice_data (cached plan) against affine_transform order 0
+	tmpdir = tempfile.mkdtemp()
+	# set_space on nifti and spm analyze, others raise IOError
+	for klass, ext in [(nibabel.Nifti1Image, '.nii'),
+			   (nibabel.Nifti1Image, '.nii.gz'),
+			   (nibabel.Spm2AnalyzeImage, '.img')]:
+		spacefile = os.path.join(tmpdir, 'space' + ext)
+		klass(src.astype(np.float32), src_affine).to_filename(spacefile)
+		set_space(spacefile, target_affine)
+		np.testing.assert_almost_equal(
+			nibabel.load(spacefile).get_affine(), target_affine, decimal=5)
+		np.testing.assert_almost_equal(
+			nibabel.load(spacefile).get_data(), src, decimal=3)
+	spacefile = os.path.join(tmpdir, 'space.mgz')
+	nibabel.MGHImage(src.astype(np.float32),
+			 src_affine).to_filename(spacefile)
+	try:
+		set_space(spacefile, target_affine)
+	except IOError:
+		pass
+	else:
+		raise AssertionError('set_space should fail on %s'%spacefile)
+	srcfile = os.path.join(tmpdir, 'src.nii')
+	targetfile = os.path.join(tmpdir, 'target.nii')
+	nibabel.Nifti1Image(src, src_affine).to_filename(srcfile)
+	nibabel.Nifti1Image(np.zeros(target_shape),
+			    target_affine).to_filename(targetfile)
+	expected = affine_transform(src, Tv[:3,:3], offset=Tv[:3,3],
+				    output_shape=target_shape,
+				    order=0, mode='nearest')
+	resample_plans.clear()
+	for repeat in range(2):
+		_, data = reslice_data(targetfile, srcfile)
+		np.testing.assert_almost_equal(data, expected)
+	assert len(resample_plans.plans) == 1
+	rmtree(tmpdir)
+	## label classes against masking one label at a time
+	labels = rand.randint(-2, 3000, (30, 30, 30)).astype(np.float32)
+	classes = [[2, 41, (1000, 1035)], [2, 7, 8], [(1000, 1002), 5000]]
+	expected = np.zeros(labels.shape, dtype=np.uint8)
+	for val, labelset in enumerate(classes):
+		for label in labelset:
+			if hasattr(label, '__iter__'):
+				found = np.logical_and(labels >= label[0],
+						       labels <= label[1])
+			else:
+				found = labels == label
+			expected[found] = val + 1
+	np.testing.assert_equal(classify_labels(labels, classes), expected)
+	lut = label_lut(classes, 1040)
+	np.testing.assert_equal(lut[[0, 2, 7, 41, 1001, 1010, 1036]],
+				[0, 2, 2, 1, 3, 1, 0])
+	## label means against nested per roi, per label masking
+	labelint = rand.randint(0, 6, (20, 22, 18))
+	# resliced / scaled labels are not exact integers
+	noisy = labelint + rand.uniform(-1e-3, 1e-3, labelint.shape)
+	data = rand.normal(1, 1, labelint.shape)
+	data[0] = np.nan
+	othermask = (rand.rand(*labelint.shape) > 0.3).astype(np.float32)
+	roid = {'a' : [1, 2], 'b' : [3], 'c' : [5, 4, 1], 'd' : []}
+	expected = {}
+	allmask = np.zeros(labelint.shape, dtype=bool)
+	for roi, mask in roid.items():
+		fullmask = np.zeros(labelint.shape, dtype=bool)
+		for label_id in mask:
+			fullmask = np.logical_or(fullmask, labelint == label_id)
+			fullmask = np.logical_and(fullmask, data > 0)
+			fullmask = np.logical_and(fullmask, othermask > 0)
+			allmask = np.logical_or(allmask, fullmask)
+			expected[roi] = [data[fullmask].mean(), fullmask.sum()]
+	expected['ALL'] = [data[allmask].mean(), allmask.sum()]
+	tmpdir = tempfile.mkdtemp()
+	labelfile = os.path.join(tmpdir, 'labels.nii')
+	maskfile = os.path.join(tmpdir, 'othermask.nii')
+	nibabel.Nifti1Image(noisy.astype(np.float32),
+			    src_affine).to_filename(labelfile)
+	nibabel.Nifti1Image(othermask, src_affine).to_filename(maskfile)
+	meand = mean_from_labels(roid, labelfile, data, othermask=maskfile)
+	assert sorted(meand.keys()) == sorted(expected.keys())
+	for roi, (roimean, nvox) in expected.items():
+		np.testing.assert_almost_equal(meand[roi], [roimean, nvox])
+	stats = label_stats(noisy, data)
+	np.testing.assert_equal(stats['label'], np.arange(6))
+	for ind, label_id in enumerate(stats['label']):
+		vals = data[np.logical_and(labelint == label_id, data > 0)]
+		np.testing.assert_almost_equal([stats['count'][ind],
+						stats['sum'][ind],
+						stats['sumsq'][ind],
+						stats['min'][ind],
+						stats['max'][ind]],
+					       [vals.shape[0], vals.sum(),
+						(vals**2).sum(), vals.min(),
+						vals.max()])
+	rmtree(tmpdir)
+	## smoothing against scipy.ndimage.gaussian_filter
+	from scipy.ndimage import gaussian_filter
+	sigmas = fwhm_to_sigma(8, src_affine)
+	expected = gaussian_filter(src, sigmas, mode='constant')
+	for method in ['separable', 'fft']:
+		smoothed = smooth_stack(src, src_affine, 8, method=method)
+		np.testing.assert_almost_equal(smoothed, expected, decimal=3)
+		assert smoothed.dtype == np.float32
+	## frame windows against numpy mean / sum of the frames
+	tmpdir = tempfile.mkdtemp()
+	frames = [rand.uniform(0, 100, (6, 7, 5)) for x in range(6)]
+	niftilist = []
+	for val, frame in enumerate(frames):
+		niftilist.append(os.path.join(tmpdir,
+					      'rB01_PIB_frame%02d.nii'%(val + 1)))
+		nibabel.Nifti1Image(frame, src_affine).to_filename(niftilist[-1])
+	for result, expected in [
+		(make_mean(niftilist), np.mean(frames, axis=0)),
+		(make_summed_image(niftilist), np.sum(frames, axis=0)),
+		(make_mean_usrdefined(niftilist, 2, 4),
+		 np.mean(frames[1:4], axis=0))]:
+		np.testing.assert_almost_equal(
+			nibabel.load(result).get_data() / expected, 1, decimal=5)
+	outfiles = reduce_frames(niftilist,
+				 [frame_window(1, 3, prefix='a_'),
+				  frame_window(3, 6, op='sum', prefix='b_')],
+				 kahan=True)
+	np.testing.assert_almost_equal(
+		nibabel.load(outfiles[1]).get_data() / np.sum(frames[2:], axis=0),
+		1, decimal=5)
+	assert make_mean_usrdefined(niftilist, 5, 9) is None
+	## nan cleaning, copies against nan_to_num, unchanged frames skipped
+	frames[2][0, 0, 0] = np.nan
+	nibabel.Nifti1Image(frames[2], src_affine).to_filename(niftilist[2])
+	nonan = clean_nan(niftilist)
+	view = nan_cleaned(niftilist)
+	for val, item in enumerate(nonan):
+		# copies are float32 (default Nifti1Header)
+		np.testing.assert_almost_equal(nibabel.load(item).get_data(),
+					       nan_to_num(frames[val]), decimal=4)
+		np.testing.assert_equal(view[val], nan_to_num(frames[val]))
+	mtimes = [os.path.getmtime(x) for x in nonan]
+	assert clean_nan(niftilist) == nonan
+	assert [os.path.getmtime(x) for x in nonan] == mtimes
+	## reference normalization, constant as the mean in the mask
+	pet, ref, other = niftilist[:3]
+	normed = os.path.join(tmpdir, 'ponsnormed.nii')
+	petdat = nibabel.load(pet).get_data()
+	refdat = nibabel.load(ref).get_data() > 50
+	expected = petdat[refdat].mean()
+	nibabel.Nifti1Image(refdat.astype(np.uint8),
+			    src_affine).to_filename(ref)
+	_, value = make_pons_normed(pet, ref, normed)
+	np.testing.assert_almost_equal(value, expected)
+	np.testing.assert_almost_equal(nibabel.load(normed).get_data(),
+				       petdat / expected, decimal=5)
+	assert read_sidecar(normed)['value'] == value
+	# batch across subjects, failed jobs come back as None
+	jobs = [(pet, ref, os.path.join(tmpdir, 'batch%d.nii'%x))
+		for x in range(3)]
+	jobs.append((pet, os.path.join(tmpdir, 'missing.nii'),
+		     os.path.join(tmpdir, 'batch_missing.nii')))
+	batch = normalize_reference_batch(jobs)
+	assert batch[-1] is None
+	for (outfile, batchvalue), job in zip(batch[:-1], jobs):
+		assert outfile == job[2]
+		np.testing.assert_almost_equal(batchvalue, value)
+	## renormalizing to another region needs only the normed image
+	otherdat = nibabel.load(other).get_data() > 50
+	nibabel.Nifti1Image(otherdat.astype(np.uint8),
+			    src_affine).to_filename(other)
+	_, value = renormalize_reference(normed, other,
+					 os.path.join(tmpdir, 'renormed.nii'),
+					 stat='median')
+	np.testing.assert_almost_equal(value, np.median(petdat[otherdat]),
+				       decimal=4)
+	## rigid_matrix against spm_matrix rotations
+	np.testing.assert_almost_equal(rigid_matrix([1, 2, 3, 0, 0, 0])[:3,3],
+				       [1, 2, 3])
+	for x, rot in [([0, 0, 0, np.pi / 2, 0, 0],
+			[[1, 0, 0], [0, 0, 1], [0, -1, 0]]),
+		       ([0, 0, 0, 0, np.pi / 2, 0],
+			[[0, 0, 1], [0, 1, 0], [-1, 0, 0]]),
+		       ([0, 0, 0, 0, 0, np.pi / 2],
+			[[0, 1, 0], [-1, 0, 0], [0, 0, 1]])]:
+		np.testing.assert_almost_equal(rigid_matrix(x)[:3,:3], rot)
+	M = rigid_matrix([4, -3, 2, 0.05, -0.04, 0.06])
+	np.testing.assert_almost_equal(dot(M[:3,:3], M[:3,:3].T), np.eye(3))
+	np.testing.assert_almost_equal(np.linalg.det(M), 1)
+	np.testing.assert_almost_equal(rigid_matrix(np.zeros(6)), np.eye(4))
+	## nmi against entropies from np.histogram2d
+	a = rand.randint(0, 256, 20000).astype(np.float32)
+	b = np.clip(a + rand.randint(-20, 20, a.shape), 0, 255)
+	hist = joint_histogram(a, b, fwhm=(0, 0))
+	expected, _, _ = np.histogram2d(a, b, bins=256, range=[[0, 256],
+							       [0, 256]])
+	np.testing.assert_equal(hist, expected)
+	p = expected[expected > 0] / expected.sum()
+	pa = expected.sum(axis=1)[expected.sum(axis=1) > 0] / expected.sum()
+	pb = expected.sum(axis=0)[expected.sum(axis=0) > 0] / expected.sum()
+	nmi = (-(pa * np.log(pa)).sum() - (pb * np.log(pb)).sum()) / \
+	      -(p * np.log(p)).sum()
+	np.testing.assert_almost_equal(normalized_mutual_information(hist),
+				       nmi, decimal=4)
+	np.testing.assert_almost_equal(normalized_mutual_information(
+		joint_histogram(a, a, fwhm=(0, 0))), 2, decimal=4)
+	## rigid_coreg recovers a known rigid motion of the header
+	shape = (40, 40, 32)
+	grid = np.mgrid[0:40, 0:40, 0:32].astype(float)
+	blobs = np.zeros(shape)
+	for _ in range(12):
+		center = rand.uniform([8, 8, 6], [32, 32, 26]).reshape((3, 1, 1, 1))
+		width = rand.uniform(2, 5)
+		blobs += rand.uniform(0.5, 2) * \
+			 np.exp(-((grid - center)**2).sum(axis=0) / (2 * width**2))
+	pet_affine = np.diag([3., 3., 3., 1.])
+	pet_affine[:3,3] = -np.array(shape) * 1.5
+	xtrue = np.array([4., -3., 2., 0.05, -0.04, 0.06])
+	petfile = os.path.join(tmpdir, 'coreg_pet.nii')
+	mrifile = os.path.join(tmpdir, 'coreg_mri.nii')
+	nibabel.Nifti1Image(blobs.astype(np.float32),
+			    pet_affine).to_filename(petfile)
+	# other contrast, moved by xtrue
+	nibabel.Nifti1Image((3 - np.sqrt(blobs)).astype(np.float32),
+			    dot(rigid_matrix(xtrue),
+				pet_affine)).to_filename(mrifile)
+	x = rigid_coreg(petfile, mrifile)
+	np.testing.assert_array_less(np.abs(x - xtrue)[:3], 0.5) # mm
+	np.testing.assert_array_less(np.abs(x - xtrue)[3:], 0.01) # radians
+	# invert_coreg moves the mri back onto the pet
+	xfm = os.path.join(tmpdir, 'coreg_xfm.mat')
+	invert_coreg(mrifile, petfile, xfm)
+	np.testing.assert_array_less(np.abs(nibabel.load(mrifile).get_affine() -
+					    pet_affine), 1.0)
+	np.testing.assert_almost_equal(load_transform(xfm),
+				       np.linalg.inv(rigid_matrix(x)), decimal=4)
+	# failures in the search (here a ValueError) come back as IOError
+	try:
+		rigid_coreg(petfile, mrifile, x0=[0, 0])
+	except IOError:
+		pass
+	else:
+		raise AssertionError('rigid_coreg should fail on %s'%mrifile)
+	rmtree(tmpdir)
+
 	## test generateing freesurfer label dictionaries
 	lut = '/usr/local/freesurfer_x86_64-4.5.0/ASegStatsLUT.txt'
 	outd = aseg_label_dict(lut)
@@ -1,13 +1,89 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 #!/usr/bin/env python
-import os
+import sys, os
+import hashlib
+import tempfile
 import nibabel
 import numpy as np
 
 import scipy.weave as weave
 from scipy.weave import converters
 import numpy
+from numpy.lib.stride_tricks import as_strided
+import time
+sys.path.insert(0, '/home/jagust/cindeem/CODE/PetProcessing')
+from fileio import atomic_write
+
+
+def _window_view(arr, width, axes):
+    """returns a strided view of arr holding every window of length
+    width along each axis in axes (no data is copied)
+    windowed axes shrink by width - 1, and the window dims are
+    appended to the end of the view in the order of axes
+    """
+    shape = list(arr.shape)
+    strides = list(arr.strides)
+    for ax in axes:
+        shape[ax] = shape[ax] - width + 1
+    shape = shape + [width] * len(axes)
+    strides = strides + [arr.strides[ax] for ax in axes]
+    return as_strided(arr, shape=tuple(shape), strides=tuple(strides))
+
+
+class PsfKernelBank():
+    """holds PetPsf xy and z kernels keyed by scanner grid
+    (slice matrix dims, voxel size, halfwidth and resolution table)
+    so every roi, subject and rerun on the same grid reuses them
+    """
+
+    def __init__(self, kernel_dir=None):
+        """
+        Parameters
+        ----------
+        kernel_dir : if not None, directory where kernels are also
+                     saved as .npz files and looked up on a memory miss
+        """
+        self.kernel_dir = kernel_dir
+        self._kernels = {}
+
+    def filename(self, key):
+        """ .npz file in kernel_dir holding kernels for key"""
+        digest = hashlib.md5(repr(key)).hexdigest()
+        return os.path.join(self.kernel_dir, 'petpsf_kernels_%s.npz'%digest)
+
+    def get(self, petpsf):
+        """returns xy_kernels, z_kernels for the grid of petpsf,
+        loading or computing (and saving) them if not already held"""
+        key = petpsf.kernel_key()
+        if key in self._kernels:
+            return self._kernels[key]
+        kernfile = None
+        if self.kernel_dir is not None:
+            kernfile = self.filename(key)
+        if kernfile is not None and os.path.isfile(kernfile):
+            npz = np.load(kernfile)
+            kernels = (npz['xy'], npz['z'])
+        else:
+            kernels = (petpsf.compute_xy_kernels(),
+                       petpsf.compute_z_kernels())
+            if kernfile is not None:
+                # concurrent runs never see a partial file
+                def write(tmpfile):
+                    fid = open(tmpfile, 'wb')
+                    np.savez(fid, xy=kernels[0], z=kernels[1])
+                    fid.close()
+                atomic_write(kernfile, write)
+        self._kernels[key] = kernels
+        return kernels
+
+    def clear(self):
+        """drop all kernels held in memory"""
+        self._kernels.clear()
+
+
+# shared by all PetPsf instances that are not given their own bank
+kernel_bank = PsfKernelBank()
 
 
 class PetPsf():
@@ -19,14 +95,20 @@ class PetPsf():
     _halfwidth = 7; # predefined by previous testing on scanner
     _base_divisor = 2.35482  #standard constant
     
-    def __init__(self, infile):
+    def __init__(self, infile, bank=None):
         """this class loads in am image, and applies the point spread
         function specific to the PET scanner up at LBL to the image
 
         Parameters
         ----------
         infile : file of image to apply pet scanner specific psf
+
+        bank : PsfKernelBank to get kernels from
+               (default: module level kernel_bank)
         """
+        if bank is None:
+            bank = kernel_bank
+        self.kernel_bank = bank
 
         self.img = nibabel.load(infile)
         dat =  self.img.get_data().squeeze()
@@ -92,7 +174,6 @@ class PetPsf():
         dy = (center_pixel[1] - y) * self.voxel_res[1]
 
         radius = np.sqrt(dx**2 + dy**2 )# in mm
-        print radius
         if radius > 0.0:
             angle = np.arctan2(dy,dx)
         else:
@@ -128,7 +209,6 @@ class PetPsf():
         # or dont alter the data
         if (sigma_rad <= 0.0) or (sigma_tan <= 0.0):
             kern[length * length / 2] = 1.0
-            print 'returning delta'
             return kern
         cos_theta = np.cos(angle)
         sin_theta = np.sin(angle)
@@ -147,31 +227,116 @@ class PetPsf():
     
         
 
+    def _calc_sigmas(self, insigma, norm):
+        """array version of _calc_sigma, insigma can be any shape"""
+        sigma_sq = insigma**2
+        sigma_sq = sigma_sq - self.uniform_sm_sq
+        out = np.where(sigma_sq > 0.0, np.sqrt(np.maximum(sigma_sq, 0.0)), 0.0)
+        return out / norm
+
+    def kernel_key(self):
+        """key identifying the kernels of this image grid,
+        kernels only depend on the slice matrix dims, voxel size,
+        halfwidth and the scanner resolution table"""
+        table = tuple([(k, tuple(v)) for k, v in
+                       sorted(self._ecat_resolution.items())])
+        return (tuple([int(x) for x in self.matrix_dim[:2]]),
+                tuple([float(x) for x in self.voxel_res]),
+                self._halfwidth,
+                table)
+
+    def _grid_radius(self):
+        """radius (mm) from the slice center and angle of every x,y
+        voxel in the convolution range
+        returns 2 arrays of shape (nx, ny)"""
+        halfwidth = self._halfwidth
+        xmax, ymax = self.matrix_dim[:2]
+        center_pixel = np.array(self.matrix_dim[:2]) / 2.0
+        x = np.arange(halfwidth, xmax - halfwidth)
+        y = np.arange(halfwidth, ymax - halfwidth)
+        dx = ((x - center_pixel[0]) * self.voxel_res[0])[:, np.newaxis]
+        dy = ((center_pixel[1] - y) * self.voxel_res[1])[np.newaxis, :]
+        radius = np.sqrt(dx**2 + dy**2)
+        angle = np.where(radius > 0.0, np.arctan2(dy, dx), 0.0)
+        return radius, angle
+
+    def compute_xy_kernels(self):
+        """compute_xy_kernel for every x,y voxel in the convolution
+        range at once
+
+        Returns
+        -------
+        kernels : array of shape (nx, ny, N, N), N = halfwidth * 2 + 1
+        """
+        radius, angle = self._grid_radius()
+        near = radius < 100.0
+        sigma_radial = np.where(near,
+                                self.radial[0] + self.deltarad[0] * radius,
+                                self.radial[1] + self.deltarad[1] * (radius - 100.0))
+        sigma_tan = np.where(near,
+                             self.tan[0] + self.deltatan[0] * radius,
+                             self.tan[1] + self.deltatan[1] * (radius - 100.0))
+        sigma_radial = self._calc_sigmas(sigma_radial, self.average_pixel_size)
+        sigma_tan = self._calc_sigmas(sigma_tan, self.average_pixel_size)
+        return self._calc_gauss2d_kernels(sigma_radial, sigma_tan, angle)
+
+    def _calc_gauss2d_kernels(self, sigma_rad, sigma_tan, angle):
+        """array version of _calc_gauss2d_kernel,
+        returns (sigma_rad.shape + (N, N)) kernels, N = halfwidth * 2 + 1
+        voxels with either sigma <= 0 get a delta function
+        """
+        halfwidth = self._halfwidth
+        length = halfwidth * 2 + 1
+        offset = np.arange(length) - halfwidth
+        indx = offset[:, np.newaxis]
+        indy = offset[np.newaxis, :]
+        cos_theta = np.cos(angle)[..., np.newaxis, np.newaxis]
+        sin_theta = np.sin(angle)[..., np.newaxis, np.newaxis]
+        sigma_rad_sq = (sigma_rad**2)[..., np.newaxis, np.newaxis]
+        sigma_tan_sq = (sigma_tan**2)[..., np.newaxis, np.newaxis]
+
+        u = indx * cos_theta - indy * sin_theta
+        v = indx * sin_theta + indy * cos_theta
+        olderr = np.seterr(divide='ignore', invalid='ignore')
+        val = np.exp(-.5 * u * u / sigma_rad_sq)
+        val = val * np.exp(-.5 * v * v / sigma_tan_sq)
+        np.seterr(**olderr)
+        flat = val.reshape(val.shape[:-2] + (length * length,))
+        val = val / flat.sum(axis=-1)[..., np.newaxis, np.newaxis]
+
+        delta = np.logical_or(sigma_rad <= 0.0, sigma_tan <= 0.0)
+        val[delta] = 0.0
+        val[delta, halfwidth, halfwidth] = 1.0
+        return val
+
+    def _apply_xy(self, dat):
+        """applies the xy kernels to dat (..., x, y, z), which must be
+        on the grid of this image, leading dims are batched
+        borders in x, y are left at zero"""
+        halfwidth = self._halfwidth
+        length = halfwidth * 2 + 1
+        xmax, ymax, zmax = dat.shape[-3:]
+        ndim = dat.ndim
+
+        psfdat = np.zeros(dat.shape)
+        kernels, _ = self.kernel_bank.get(self)
+        # windows[..., x, y, z] is the N x N patch centered on x+hw, y+hw
+        windows = _window_view(dat, length, (ndim - 3, ndim - 2))
+        psfdat[..., halfwidth:xmax - halfwidth,
+               halfwidth:ymax - halfwidth, :] = np.einsum('...xyzij,xyij->...xyz',
+                                                          windows, kernels)
+        return psfdat
+
     def convolve_xy(self):
         """ convolve the xy specific 2D kernel with points in
         the data slices in the x-y plane
+        all kernels are built at once, and applied to every z
+        with one einsum over a strided window view of the data
         returns result as an array in case you want
         to save it or check it out
         """
-
-        xmax, ymax, zmax = self.matrix_dim
-
-        psfdat = np.zeros(self.matrix_dim)
-        xrange = np.arange(self._halfwidth, xmax - self._halfwidth)
-        yrange = np.arange(self._halfwidth, ymax - self._halfwidth)
-
-        for x in xrange:
-            for y in yrange:
-                kern = self.compute_xy_kernel(x,y)
-                half_kern = kern.shape[0]/2
-                for z in np.arange(zmax):
-                    tmp = self.dat[x-self._halfwidth:x+self._halfwidth+1,
-                                   y-self._halfwidth:y+self._halfwidth+1,
-                                   z].ravel()
-                    psfdat[x,y,z] = np.sum(tmp * kern)
-        self.xy_psf = psfdat
-        return psfdat
-
+        self.xy_psf = self._apply_xy(self.dat)
+        return self.xy_psf
 
     def wconvolve_xy(self):
         """convolve the xy specific 2D kernel with points in
@@ -262,44 +427,83 @@ class PetPsf():
         kern = kern / np.sum(kern)
         return kern
         
+    def compute_z_kernels(self):
+        """compute_z_kernel for every x,y voxel in the convolution
+        range at once
+
+        Returns
+        -------
+        kernels : array of shape (nx, ny, N), N = halfwidth * 2 + 1
+        """
+        halfwidth = self._halfwidth
+        radius, _ = self._grid_radius()
+        sigma_axial = np.where(radius < 100,
+                               self.axial[0] + self.deltaaxial[0] * radius,
+                               self.axial[1] + self.deltaaxial[1] * (radius - 100.0))
+        sigma_axial = self._calc_sigmas(sigma_axial, self.voxel_res[2])
+
+        x = np.arange(-halfwidth, halfwidth + 1)
+        olderr = np.seterr(divide='ignore', invalid='ignore')
+        kern = np.exp(-.5 * x**2 / (sigma_axial**2)[..., np.newaxis])
+        kern = kern / np.sum(kern, axis=-1)[..., np.newaxis]
+        np.seterr(**olderr)
+        delta = sigma_axial < 0.0
+        kern[delta] = 0.0
+        kern[delta, halfwidth] = 1.0
+        return kern
+
+    def _apply_z(self, xy_psf):
+        """applies the z kernels to xy_psf (..., x, y, z), which must be
+        on the grid of this image, leading dims are batched
+        data is zero padded in z"""
+        halfwidth = self._halfwidth
+        length = halfwidth * 2 + 1
+        xmax, ymax, zmax = xy_psf.shape[-3:]
+        lead = xy_psf.shape[:-3]
+
+        finaldat = np.zeros(xy_psf.shape)
+        _, kernels = self.kernel_bank.get(self)
+        padded = np.zeros(lead + (xmax - 2 * halfwidth,
+                                  ymax - 2 * halfwidth,
+                                  zmax + 2 * halfwidth))
+        padded[..., halfwidth:halfwidth + zmax] = \
+                  xy_psf[..., halfwidth:xmax - halfwidth,
+                         halfwidth:ymax - halfwidth, :]
+        windows = _window_view(padded, length, (padded.ndim - 1,))
+        finaldat[..., halfwidth:xmax - halfwidth,
+                 halfwidth:ymax - halfwidth, :] = np.einsum('...xyzk,xyk->...xyz',
+                                                            windows, kernels)
+        return finaldat
+
     def convolve_z(self):
         """ convolve the results of the xy_smooth with
         a new kernel computed in the z direction
         """
-        halfwidth = self._halfwidth
-        xmax, ymax, zmax = self.matrix_dim
+        self.finaldat = self._apply_z(self.xy_psf)
+        return self.finaldat
 
-        psfdat = np.zeros(self.matrix_dim)
-        xrange = np.arange(halfwidth, xmax - halfwidth)
-        yrange = np.arange(halfwidth, ymax - halfwidth)
+    def convolve_stack(self, stack, chunksize=10):
+        """ applies the xy then z psf to every volume in stack,
+        sharing kernels and window views across volumes
 
-        finaldat = np.zeros(self.matrix_dim)
-        
-        for x in xrange:
-            for y in yrange:
-                kern = self.compute_z_kernel(x,y)
-                for z in np.arange(0,
-                                   zmax):
-                    if (z - halfwidth) <= 0:
-                        tmpdat = np.zeros(15)
-                        if z == 0:
-                            tmpdat[7:] = self.xy_psf[x,y,z:z+halfwidth + 1]
-                        else:
-                            tmpdat[7 - z :] = self.xy_psf[x,y,0:z+halfwidth + 1]
-                    elif (z + halfwidth + 1 > zmax):
-                        tmpdat = np.zeros(15)
-                        if z == zmax:
-                            tmpdat[:7] = self.xy_psf[x,y,z-halfwidth:]
-                        else:
-                            tmpdat[:15-(8-(zmax-z))] = self.xy_psf[x,y,z-halfwidth:]
-                    else:
-                        tmpdat = self.xy_psf[x,y, z - halfwidth : z + halfwidth + 1]
-
-                    finaldat[x,y,z] = np.sum(tmpdat * kern)
-                                   
-
-        self.finaldat = finaldat
-        return finaldat
+        Parameters
+        ----------
+        stack : array (nvol, x, y, z) on the same grid as this image
+        chunksize : number of volumes convolved together,
+                    bounds the size of intermediate arrays
+
+        Returns
+        -------
+        psf : array (nvol, x, y, z)
+        """
+        if not stack.shape[1:] == tuple(self.matrix_dim):
+            raise IOError('stack has shape %s, not (n,) + %s'%(stack.shape,
+                                                              self.matrix_dim))
+        psf = np.zeros(stack.shape)
+        for start in range(0, stack.shape[0], chunksize):
+            chunk = stack[start:start + chunksize]
+            psf[start:start + chunksize] = self._apply_z(self._apply_xy(chunk))
+        return psf
 
     def save_result(self, filename=None):
         """ saves the result of smoothing input in xy, and z to a new file
@@ -321,8 +525,96 @@ class PetPsf():
         newimg.to_filename(filename)
         return filename
 
+def check_convolve(infile, nvoxels=50, nslices=None):
+    """times the vectorized convolve_xy against the old per voxel
+    compute_xy_kernel loop on one z slice, and checks convolve_xy /
+    convolve_z against the kernels of compute_xy_kernel /
+    compute_z_kernel applied directly at nvoxels random voxels of infile
+
+    Parameters
+    ----------
+    infile : image to apply pet scanner specific psf
+    nvoxels : number of voxels to check
+    nslices : if not None, only use the first nslices z slices
+
+    Returns
+    -------
+    results : dict of per voxel loop and vectorized run times of the
+              slice (seconds), their speedup, the vectorized run time
+              of the whole volume and the max absolute difference
+              at the checked voxels
+    """
+    # own bank, so the vectorized slice time includes building kernels
+    petpsf = PetPsf(infile, bank=PsfKernelBank())
+    if nslices is not None:
+        petpsf.dat = petpsf.dat[:, :, :nslices]
+        petpsf.matrix_dim = petpsf.dat.shape
+    hw = petpsf._halfwidth
+    xmax, ymax, zmax = petpsf.matrix_dim
+
+    # old path, one kernel per x,y voxel applied in python
+    zslice = zmax // 2
+    loopslice = np.zeros((xmax, ymax))
+    start = time.time()
+    for x in range(hw, xmax - hw):
+        for y in range(hw, ymax - hw):
+            kern = petpsf.compute_xy_kernel(x, y)
+            patch = petpsf.dat[x - hw:x + hw + 1, y - hw:y + hw + 1, zslice]
+            loopslice[x, y] = np.sum(patch.ravel() * kern)
+    looptime = time.time() - start
+
+    start = time.time()
+    fastslice = petpsf._apply_xy(petpsf.dat[:, :, zslice:zslice + 1])
+    slicetime = time.time() - start
+    maxdiff = np.abs(fastslice[:, :, 0] - loopslice).max()
+
+    start = time.time()
+    xyresult = petpsf.convolve_xy()
+    result = petpsf.convolve_z()
+    fasttime = time.time() - start
+
+    rand = np.random.RandomState(0)
+    for _ in range(nvoxels):
+        x = rand.randint(hw, xmax - hw)
+        y = rand.randint(hw, ymax - hw)
+        z = rand.randint(0, zmax)
+        patch = petpsf.dat[x - hw:x + hw + 1, y - hw:y + hw + 1, z]
+        xyval = np.sum(patch.ravel() * petpsf.compute_xy_kernel(x, y))
+        # z is zero padded
+        column = np.zeros(zmax + 2 * hw)
+        column[hw:hw + zmax] = xyresult[x, y, :]
+        zval = np.sum(column[z:z + 2 * hw + 1] * petpsf.compute_z_kernel(x, y))
+        maxdiff = max(maxdiff, abs(xyval - xyresult[x, y, z]),
+                      abs(zval - result[x, y, z]))
+    return dict(loop=looptime, vectorized=slicetime,
+                speedup=looptime / max(slicetime, 1e-9),
+                volume=fasttime, maxdiff=maxdiff)
+
+
 if __name__ == '__main__':
 
+    import shutil
+
+    # kernels saved to kernel_dir reload equal to the in memory ones
+    tmpdir = tempfile.mkdtemp()
+    tmpimg = os.path.join(tmpdir, 'psf_check.nii')
+    nibabel.Nifti1Image(np.random.RandomState(1).rand(40, 40, 8),
+                        np.diag([2.0, 2.0, 2.4, 1])).to_filename(tmpimg)
+    kernel_dir = os.path.join(tmpdir, 'kernels')
+    os.mkdir(kernel_dir)
+    bank = PsfKernelBank(kernel_dir)
+    petpsf = PetPsf(tmpimg, bank=bank)
+    xy, z = bank.get(petpsf)
+    kernfile = bank.filename(petpsf.kernel_key())
+    assert os.path.isfile(kernfile)
+    assert os.listdir(kernel_dir) == [os.path.basename(kernfile)]
+    reloaded = PsfKernelBank(kernel_dir)
+    loadxy, loadz = reloaded.get(PetPsf(tmpimg, bank=reloaded))
+    np.testing.assert_equal(loadxy, xy)
+    np.testing.assert_equal(loadz, z)
+    np.testing.assert_equal(loadxy, petpsf.compute_xy_kernels())
+    np.testing.assert_equal(loadz, petpsf.compute_z_kernels())
+    shutil.rmtree(tmpdir)
 
     # this SHOULD be resliced into space of pet image, but we are lazy
     infile = '/home/jagust/cindeem/CODE/pverousset/tmp_atrophy_smooth/rgm_seg_bin.nii'
@@ -331,3 +623,9 @@ if __name__ == '__main__':
     xyresult = petpsf.convolve_xy()
     zresult = petpsf.convolve_z()
     newfile = petpsf.save_result()
+
+    # vectorized against kernels applied voxel by voxel
+    check = check_convolve(infile)
+    print 'xy slice: loop %(loop)2.2fs, vectorized %(vectorized)2.2fs'%check,
+    print '(%(speedup)2.1fx), volume %(volume)2.2fs, max diff %(maxdiff)g'%check
+    np.testing.assert_almost_equal(check['maxdiff'], 0, decimal=6)
@@ -9,8 +9,6 @@ sys.path.insert(0, '/home/jagust/cindeem/CODE/PetProcessing/pvc')
 import ecat_smooth as es
 import nibabel as ni
 import nipype.interfaces.freesurfer as freesurfer
-import nipy
-import nipy.algorithms
 
 def make_pvc(pet, psf_brainmask, brainmask, prefix = 'pvc_'):
     """ uses the given per psf brain mask to correct the data in pet
@@ -52,11 +50,8 @@ def make_aseg_brainmask(infile):
                (58,60),(77,77),(251,255),(1000,5000))
     aseg = ni.load(infile)
     asegd = aseg.get_data()
-
-    newdat = np.zeros(aseg.get_shape())
-    for low, high in maskint:
-        tmp = np.logical_and(asegd>= low, asegd<=high)
-        newdat[tmp] = 1
+    # one lookup over the volume for all intervals
+    newdat = pp.classify_labels(asegd, [maskint]).astype(float)
 
     newimg = ni.Nifti1Image(newdat, aseg.get_affine())
     outfile = infile.replace('aseg', 'aseg_brainmask')
@@ -64,24 +59,24 @@ def make_aseg_brainmask(infile):
     return outfile
 
 def smooth_mask_spm(mask, fwhm = 7):
-    sout = pp.spm_smooth([mask] , fwhm=fwhm)
-    
-    if not sout.runtime.returncode ==0:
-        print sout.runtime.stderr # changed from sout.runtime.stderr
-
+    """ smooths mask with gaussian of fwhm (mm) as spm_smooth does,
+    in process (see pp.smooth_files), returns smoothed file"""
+    try:
+        return pp.smooth_files([mask], fwhm=fwhm)[0]
+    except IOError as e:
+        print e
         return None
-    else:
-        return sout.outputs.smoothed_files    
 
 
 def smooth_mask_nipy(infile, outfile, fwhm=14):
-    """uses nipy to smooth an image using gaussian filter of fwhm"""
-    img = nipy.load_image(infile)
-    lf = nipy.algorithms.kernel_smooth.LinearFilter(img.coordmap,
-                                                    img.shape,
-                                                    fwhm)
-    simg = lf.smooth(img)
-    outimg = nipy.save_image(simg, outfile)
+    """smooths an image using gaussian filter of fwhm (mm),
+    separable float32 passes (pp.smooth_stack), returns nibabel image"""
+    img = ni.load(infile)
+    dat = np.nan_to_num(img.get_data())
+    dat = dat.reshape(dat.shape[:3])
+    smoothed = pp.smooth_stack(dat, img.get_affine(), fwhm)
+    outimg = ni.Nifti1Image(smoothed, img.get_affine())
+    outimg.to_filename(outfile)
     return outimg
 
 def calc_pvc(pet, mask, smask):
@@ -3,6 +3,7 @@
 #!/usr/bin/env python
 import sys,os
 import numpy as np
+import scipy.sparse
 sys.path.insert(0, '/home/jagust/cindeem/CODE/PetProcessing')
 import preprocessing as pp
 sys.path.insert(0, '/home/jagust/cindeem/CODE/PetProcessing/pvc')
@@ -10,8 +11,6 @@ import ecat_smooth as es
 import metzler as metzler
 import nibabel as ni
 import nipype.interfaces.freesurfer as freesurfer
-import nipy
-import nipy.algorithms
 
 
 def check_roi_shape(rois):
@@ -47,15 +46,56 @@ def compute_rsf(rois):
     return rsfs
 
 
+def load_roi_stack(rois):
+    """ loads roi files (same shape) into one array (nroi, x, y, z)
+    with nan set to zero"""
+    sameshape, shape = check_roi_shape(rois)
+    if not sameshape:
+        raise AssertionError('ROIs do NOT have same shape, exiting program,'\
+                             'check your ROIS dimensions')
+    stack = np.zeros(tuple([len(rois)] + list(shape)))
+    for ind, roi in enumerate(rois):
+        stack[ind] = np.nan_to_num(ni.load(roi).get_data().squeeze())
+    return stack
+
+
+def compute_rsf_stack(stack, template, fwhm=4, chunksize=10):
+    """ computes an RSF for each roi mask in stack in one batched pass,
+    no intermediate files are written
+
+    Parameters
+    ----------
+    stack : array (nroi, x, y, z) of roi masks
+    template : image file on the same grid as the masks
+               (defines voxel size and affine)
+    fwhm : fwhm of the gaussian applied after the scanner psf
+    chunksize : number of rois convolved together in the psf
+
+    Returns
+    -------
+    rsfs : array (nroi, x, y, z)
+    """
+    petpsf = es.PetPsf(template)
+    rsfs = petpsf.convolve_stack(stack, chunksize=chunksize)
+    # all rois smoothed together, separable float32 passes
+    affine = ni.load(template).get_affine()
+    return pp.smooth_stack(rsfs, affine, fwhm)
+
+
+def compute_rsf_batch(rois, fwhm=4, chunksize=10):
+    """ batched version of compute_rsf, returns an RSF for each roi
+    in rois as an array (nroi, x, y, z) without writing
+    PET_PSF_* files"""
+    stack = load_roi_stack(rois)
+    return compute_rsf_stack(stack, rois[0], fwhm=fwhm, chunksize=chunksize)
+
+
 def mask_from_aseg(aparc_aseg, labels):
     """ generate binary mask based on labels from aparc aseg
     returns binary array"""
     
     labeldat = ni.load(aparc_aseg).get_data()
-    binary = np.zeros(labeldat.shape)
-    for label in labels:
-        binary[labeldat == label] = 1
-    
+    binary = pp.classify_labels(labeldat, [labels]).astype(float)
     return binary
 
 def wm_aseg():
@@ -86,26 +126,79 @@ def generate_pibindex_rois_fs(aparc_aseg):
     generate wm, gm and pibindex rois
     make sure they are non-overlapping
     return 3 rois"""
-    wm = mask_from_aseg(aparc_aseg, wm_aseg())
-    gm = mask_from_aseg(aparc_aseg,  gm_aseg())
-    pibi = mask_from_aseg(aparc_aseg, pibindex_aseg())
-    # make non-overlapping
-    wm[pibi==1] = 0
-    gm[pibi ==1] = 0
-    gm[wm==1] = 0
+    labeldat = ni.load(aparc_aseg).get_data()
+    # non-overlapping in one pass, later classes win:
+    # pibindex over wm over gm
+    classes = pp.classify_labels(labeldat,
+                                 [gm_aseg(), wm_aseg(), pibindex_aseg()])
+    gm = (classes == 1).astype(float)
+    wm = (classes == 2).astype(float)
+    pibi = (classes == 3).astype(float)
     return wm, gm, pibi
     
-def gen_transfer_matrix(rsfs, rois):
-    transfer_matrix = np.zeros((len(rsfs),len(rsfs))) #initialize TM
+def roi_sparse_matrix(rois):
+    """ loads each roi once and stores its nonzero voxels compactly
+
+    Parameters
+    ----------
+    rois : list of roi files, or array (nroi, x, y, z) of roi masks
 
+    Returns
+    -------
+    roimat : scipy.sparse.csr_matrix (nroi, nvox) holding the roi
+             values at their flat (int32) voxel indices
+    npix : array, number of voxels > 0 in each roi
+    shape : shape of a single roi volume
+    """
+    indptr = [0]
+    indices = []
+    values = []
+    npix = np.zeros(len(rois))
+    shape = None
     for jval, roi in enumerate(rois):
-        roidat = ni.load(roi).get_data()
-        roidat = np.nan_to_num(roidat)
-        npix = np.prod(roidat[roidat >0].shape)
-        # determine number of pixels in ROI
-        for ival, rsf in enumerate(rsfs):
-            # effect of one rsf on one ROI
-            transfer_matrix[jval,ival] = np.nansum(np.multiply(roidat,rsf))/npix
+        if not hasattr(roi, 'shape'):
+            roi = ni.load(roi).get_data().squeeze()
+        roidat = np.nan_to_num(roi)
+        if shape is None:
+            shape = roidat.shape
+        elif not roidat.shape == shape:
+            raise AssertionError('ROIs do NOT have same shape, %s and %s'%(
+                shape, roidat.shape))
+        flat = roidat.ravel()
+        ind = np.flatnonzero(flat).astype(np.int32)
+        indices.append(ind)
+        values.append(flat[ind])
+        indptr.append(indptr[-1] + ind.shape[0])
+        npix[jval] = (flat > 0).sum()
+    roimat = scipy.sparse.csr_matrix((np.concatenate(values),
+                                      np.concatenate(indices),
+                                      np.array(indptr, dtype=np.int32)),
+                                     shape=(len(rois), int(np.prod(shape))))
+    return roimat, npix, shape
+
+
+def gen_transfer_matrix(rsfs, rois):
+    """ generates the transfer matrix, the effect of each rsf (columns)
+    on each roi (rows), as mean of rsf * roi over the roi voxels
+
+    Parameters
+    ----------
+    rsfs : array (nroi, x, y, z) of rsfs (eg from compute_rsf_batch)
+    rois : list of roi files, or array (nroi, x, y, z) of roi masks
+
+    whole matrix is computed as one sparse roi x dense rsf product
+    """
+    rsfs = np.asarray(rsfs)
+    roimat, npix, shape = roi_sparse_matrix(rois)
+    if not rsfs.shape[1:] == shape:
+        raise AssertionError('RSFs have shape %s, ROIs %s'%(rsfs.shape[1:],
+                                                             shape))
+    rsfmat = rsfs.reshape((rsfs.shape[0], -1))
+    if np.isnan(rsfmat).any():
+        # nansum in the original, nan does not contribute
+        rsfmat = np.where(np.isnan(rsfmat), 0, rsfmat)
+    transfer_matrix = np.asarray(roimat.dot(rsfmat.T))
+    transfer_matrix = transfer_matrix / npix[:, np.newaxis]
     return transfer_matrix
 
 def get_observed_conc(pet, rois):
@@ -140,7 +233,15 @@ if __name__ == '__main__':
     to_file(gm, aff, gmf)
     to_file(pibi, aff, pibif)
     rois = [gmf, wmf, pibif]
-    rsfs = compute_rsf(rois)
+    rsfs = compute_rsf_batch(rois)
+    # batched rsfs match the per roi files of compute_rsf
+    oldrsfs = compute_rsf(rois)
+    np.testing.assert_almost_equal(rsfs, oldrsfs, decimal=5)
+    for roi in rois:
+        psffile = pp.fname_presuffix(roi, prefix='PET_PSF_')
+        for tmpfile in (psffile, pp.fname_presuffix(psffile, prefix='s')):
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
     transfer_mtx = gen_transfer_matrix(rsfs, rois)
     obs = get_observed_conc(dvr, rois)
     correct = calc_pvc_values(transfer_mtx, obs)
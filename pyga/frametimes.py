@@ -4,53 +4,162 @@ import sys, os
 import nibabel.ecat as ecat
 sys.path.insert(0, '/home/jagust/cindeem/src/pydicom-0.9.7')
 import dicom
+sys.path.insert(0, '/home/jagust/cindeem/CODE/PetProcessing')
+from fileio import atomic_write
 import numpy as np
 from datetime import datetime
 import csv
 from glob import glob
+from multiprocessing.pool import ThreadPool
 
-def get_series_iter(infile):
+# ecat7 layout, see nibabel.ecat (blocks are 512 bytes, 1-based)
+ECAT_BLOCK_SIZE = 512
+ECAT_NUM_FRAMES_OFFSET = 354 # uint16 in main header
+ECAT_DURATION_OFFSET = 46 # uint32 in image subheader
+ECAT_START_OFFSET = 50 # uint32 in image subheader
+
+# one row per frame, times in milliseconds (or as converted)
+frametimes_dtype = np.dtype([('frame', np.float64),
+                             ('start', np.float64),
+                             ('duration', np.float64),
+                             ('stop', np.float64)])
+
+# one row per dicom file of a series, built by index_dicom_series
+dicom_index_dtype = np.dtype([('x', int),
+                              ('file', 'S250'),
+                              ('mtime', np.float64),
+                              ('nslices', int),
+                              ('ntimeslices', int),
+                              ('study_time', np.float64),
+                              ('acquisition_time', np.float64),
+                              ('frame_reference_time', np.float64),
+                              ('duration', np.float64)])
+# hidden, so globs of the series dir don't pick it up as a dicom
+DICOM_INDEX_NAME = '.dicom_series_index.npy'
+
+
+def _dicom_value(plan, tag):
+    """float value of tag in plan, nan if missing"""
+    try:
+        return float(getattr(plan, tag))
+    except (AttributeError, ValueError, TypeError):
+        return np.nan
+
+def read_dicom_header(infile):
+    """reads the tags used for sorting and timing from a dicom file,
+    stopping before pixel data and deferring other large elements
+    returns a row of dicom_index_dtype"""
+    plan = dicom.read_file(infile, defer_size='1 KB',
+                           stop_before_pixels=True)
+    return (int(plan.ImageIndex),
+            infile,
+            os.path.getmtime(infile),
+            int(getattr(plan, 'NumberOfSlices', 0)),
+            int(getattr(plan, 'NumberOfTimeSlices', 0)),
+            _dicom_value(plan, 'StudyTime'),
+            _dicom_value(plan, 'AcquisitionTime'),
+            _dicom_value(plan, 'FrameReferenceTime'),
+            _dicom_value(plan, 'ActualFrameDuration'))
+
+def _cached_dicom_index(infiles, indexfile):
+    """loads indexfile if it holds exactly infiles, unmodified
+    since indexing, else returns None"""
+    if not os.path.isfile(indexfile):
+        return None
+    try:
+        index = np.load(indexfile)
+    except (IOError, ValueError):
+        return None
+    if not sorted(index['file']) == sorted(infiles):
+        return None
+    for f, mtime in zip(index['file'], index['mtime']):
+        if not os.path.getmtime(f) == mtime:
+            return None
+    return index.view(np.recarray)
+
+def index_dicom_series(infiles, indexfile=None, nthreads=8):
+    """ builds (or loads) a table of ImageIndex, timing tags and
+    file for every dicom in a series, sorted by ImageIndex
+    headers are read in a pool of nthreads, the table is saved
+    next to the series and reused while the files are unchanged
+
+    Parameters
+    ----------
+    infiles : dicom files of one series
+    indexfile : .npy file to hold the index
+                (default .dicom_series_index.npy in dir of infiles[0])
+    nthreads : number of threads reading headers
+
+    Returns
+    -------
+    index : recarray (dicom_index_dtype)
+    """
+    infiles = [str(x) for x in infiles]
+    if indexfile is None:
+        pth, _ = os.path.split(os.path.abspath(infiles[0]))
+        indexfile = os.path.join(pth, DICOM_INDEX_NAME)
+    index = _cached_dicom_index(infiles, indexfile)
+    if index is not None:
+        return index
+    pool = ThreadPool(max(1, min(nthreads, len(infiles))))
+    try:
+        rows = pool.map(read_dicom_header, infiles)
+    finally:
+        pool.close()
+    index = np.array(rows, dtype=dicom_index_dtype)
+    index.sort(order=['x', 'file']) # sort to correct order
+    try:
+        np.save(indexfile, index)
+    except (IOError, OSError):
+        pass # read only series dir, just don't cache
+    return index.view(np.recarray)
+
+def get_series_iter(infile, index=None):
     """ based on structure of current dicoms
     returns iterator for files to junm between
-    frames"""
-    plan = dicom.read_file(infile)
-    ns = plan.NumberOfSlices
-    nts = plan.NumberOfTimeSlices
-    ii = plan.ImageIndex
+    frames
+    if index (from index_dicom_series) is given it is used
+    instead of reading infile"""
+    if index is not None:
+        ns = index.nslices[0]
+        nts = index.ntimeslices[0]
+    else:
+        plan = dicom.read_file(infile, stop_before_pixels=True)
+        ns = plan.NumberOfSlices
+        nts = plan.NumberOfTimeSlices
     return np.arange(0,nts*ns, ns)
 
 
-def sort_series(infiles):
-    nfiles = len(infiles)
+def sort_series(infiles, index=None):
+    """ returns recarray of ImageIndex (x) and file
+    sorted by ImageIndex, using index_dicom_series"""
+    if index is None:
+        index = index_dicom_series(infiles)
+    nfiles = len(index)
     out = np.recarray((nfiles), dtype=[('x', int), ('file', 'S250')])
-    for val, f in enumerate(infiles):
-        plan = dicom.read_file(f)
-        ii = plan.ImageIndex
-        out.x[val] = ii
-        out.file[val] = f
-    sort_mask = out.argsort(axis=0)    
-    out = out[sort_mask]# sort to correct order
+    out.x = index.x
+    out.file = index.file
     return out
 
 
 def frametime_from_dicoms(infiles):
     """ given a dicom series,
     find timing info for each frame
+    (from the cached series index, see index_dicom_series)
     """
     frametimes = []
     files = []
-    sorted = sort_series(infiles)
-    fiter = get_series_iter(infiles[0])
-    for f in sorted.file[fiter]:
-        plan = dicom.read_file(f)
-        st = datetime.fromtimestamp(float(plan.StudyTime))
-        at = datetime.fromtimestamp(float(plan.AcquisitionTime))
-        dur = float(plan.ActualFrameDuration)
+    index = index_dicom_series(infiles)
+    fiter = get_series_iter(infiles[0], index=index)
+    for row in index[fiter]:
+        st = datetime.fromtimestamp(row.study_time)
+        at = datetime.fromtimestamp(row.acquisition_time)
+        dur = row.duration
         start = (at -st).microseconds * 1000
-        frt = datetime.fromtimestamp(float(plan.FrameReferenceTime))
+        frt = datetime.fromtimestamp(row.frame_reference_time)
         end = start + dur
         frametimes.append([frt.microsecond * 1000, at.microsecond * 1000, dur, st.microsecond * 1000])
-        files.append(f)
+        files.append(row.file)
     return frametimes, files
         
 
@@ -85,10 +194,79 @@ def frametime_from_ecat(ecatf):
     return out
 
 
-def frametimes_from_ecats(filelist):
+def _read_ecat_mlist(fid, endian):
+    """reads ecat matrix list with endian ('>' or '<'),
+    returns (nmatrix, 4) int array or None if blocks don't parse"""
+    dt = np.dtype('%si4'%endian)
+    rows = []
+    blockno = 2
+    while True:
+        fid.seek((blockno - 1) * ECAT_BLOCK_SIZE)
+        block = np.frombuffer(fid.read(ECAT_BLOCK_SIZE), dtype=dt)
+        if not block.shape[0] == 128:
+            return None
+        block.shape = (32, 4)
+        nfree, blockno, _, nused = block[0]
+        if not nfree + nused == 31:
+            return None
+        rows.append(block[1:nused + 1])
+        if blockno <= 2:
+            break
+    return np.vstack(rows).astype(int)
+
+def read_ecat_timing(ecatf):
+    """reads only the main header, matrix list and subheaders
+    (no pixel data) of ecat7 file ecatf
+
+    Returns
+    -------
+    out : structured array (frametimes_dtype)
+          framenumber, starttime, duration, endtime in milliseconds
+          sorted by frame, same values as frametime_from_ecat
+    """
+    fid = open(ecatf, 'rb')
+    try:
+        for endian in ('>', '<'):
+            mlist = _read_ecat_mlist(fid, endian)
+            if mlist is not None:
+                break
+        if mlist is None:
+            raise IOError('unable to read matrix list of %s'%(ecatf))
+        fid.seek(ECAT_NUM_FRAMES_OFFSET)
+        num_frames = np.frombuffer(fid.read(2), dtype='%su2'%endian)[0]
+        mlist = mlist[mlist[:,1] > 0]
+        starts = np.zeros(mlist.shape[0])
+        durs = np.zeros(mlist.shape[0])
+        for i, blockno in enumerate(mlist[:,1]):
+            fid.seek((blockno - 1) * ECAT_BLOCK_SIZE + ECAT_DURATION_OFFSET)
+            dur, startt = np.frombuffer(fid.read(8), dtype='%su4'%endian)
+            starts[i] = startt
+            durs[i] = dur
+    finally:
+        fid.close()
+    # frames in this file are the last of the series (as nibabel)
+    ids = mlist[:,0].copy()
+    nvalid = (ids > 0).sum()
+    ids[ids <= 0] = ids.max() + 1
+    valid_order = np.argsort(ids, kind='mergesort')[:nvalid]
+    framenumbers = max(num_frames, mlist.shape[0]) - nvalid + valid_order + 1
+    if starts[0] == 16:
+        adj = 16
+    else:
+        adj = 0
+    out = np.zeros(nvalid, dtype=frametimes_dtype)
+    out['frame'] = framenumbers
+    out['start'] = starts[:nvalid] - adj
+    out['duration'] = durs[:nvalid]
+    out['stop'] = starts[:nvalid] - adj + durs[:nvalid]
+    out.sort(order='frame')
+    return out
+
+def frametimes_from_ecats(filelist, nthreads=8):
     """
     for each ecat file in filelist
     gets the frame number, start, duration info
+    reading only ecat headers, files are read in a pool of nthreads
     combines
     sorts and retruns
 
@@ -101,16 +279,21 @@ def frametimes_from_ecats(filelist):
     """
     if not hasattr(filelist, '__iter__'):
         filelist = [filelist]
-    for f in filelist:
-        tmp = frametime_from_ecat(f)
-        try:
-            out = np.vstack((out, tmp))
-        except:
-            out = tmp
-    out = out[out[:,0].argsort(),]
+    pool = ThreadPool(max(1, min(nthreads, len(filelist))))
+    try:
+        timings = pool.map(read_ecat_timing, filelist)
+    finally:
+        pool.close()
+    nframes = sum([x.shape[0] for x in timings])
+    table = np.empty(nframes, dtype=frametimes_dtype)
+    start = 0
+    for tmp in timings:
+        table[start:start + tmp.shape[0]] = tmp
+        start += tmp.shape[0]
+    table.sort(order='frame')
+    out = table.view(np.float64).reshape((nframes, 4))
     return out
 
-
 def frametimes_to_seconds(frametimes, type = 'sec'):
     """ assumes a frametimes array
     type = 'sec', or 'min'
@@ -133,13 +316,40 @@ def make_outfile(infile, name = 'frametimes'):
     newfile = os.path.join(pth, newname)
     return newfile
 
+def frametimes_sidecar(infile):
+    """ name of the binary (.npy) frametimes file kept next to
+    a frametimes csv"""
+    base, _ = os.path.splitext(infile)
+    return base + '.npy'
+
+def save_frametimes(inarray, outfile):
+    """saves (nframes, 4) frametimes array as a typed
+    (frametimes_dtype) .npy record, which can be memory mapped"""
+    record = np.zeros(inarray.shape[0], dtype=frametimes_dtype)
+    for val, name in enumerate(frametimes_dtype.names):
+        record[name] = inarray[:,val]
+    # write new file and rename, so arrays mapped from an older
+    # record (load_frametimes) keep their data
+    def write(tmpfile):
+        fid = open(tmpfile, 'wb')
+        np.save(fid, record)
+        fid.close()
+    return atomic_write(outfile, write)
+
 def write_frametimes(inarray, outfile):
-    csv_writer = csv.writer(open(outfile, 'w+'))
+    """writes frametimes csv (export), and the binary .npy
+    record next to it that load_frametimes reads"""
+    fid = open(outfile, 'w+')
+    csv_writer = csv.writer(fid)
     csv_writer.writerow(['frame', 'start', 'duration','stop'])
     for row in inarray:
         csv_writer.writerow(row)
+    fid.close()
+    save_frametimes(np.asarray(inarray, dtype=float),
+                    frametimes_sidecar(outfile))
 
-def read_frametimes(infile):
+def read_frametimes_csv(infile):
+    """ parses a frametimes csv, returns array sorted by frame"""
     outarray = []
     jnk = csv.reader(open(infile),delimiter=',' )
     for row in jnk:
@@ -150,7 +360,44 @@ def read_frametimes(infile):
     outarray = outarray[outarray[:,0].argsort(),]
     return outarray
 
+# (abspath, mtime) -> frametimes array, see load_frametimes
+_frametimes_cache = {}
+
+def load_frametimes(infile):
+    """ loads frametimes from a .npy record or a csv (using its
+    .npy sidecar when it is up to date), parsing each file only once
+    per process
 
+    Returns
+    -------
+    out : read only array (nframes, 4)
+          [frame, start, duration, stop] sorted by frame
+    """
+    infile = os.path.abspath(infile)
+    if not infile.endswith('.npy'):
+        sidecar = frametimes_sidecar(infile)
+        if os.path.isfile(sidecar) and \
+           os.path.getmtime(sidecar) >= os.path.getmtime(infile):
+            infile = sidecar
+    key = (infile, os.path.getmtime(infile))
+    if key in _frametimes_cache:
+        return _frametimes_cache[key]
+    if infile.endswith('.npy'):
+        record = np.load(infile, mmap_mode='r')
+        # (nframes, 4) float view of the memory mapped record
+        out = np.asarray(record).view(np.float64).reshape((-1, 4))
+        if np.any(np.diff(out[:,0]) < 0):
+            out = out[out[:,0].argsort(),]
+    else:
+        out = read_frametimes_csv(infile)
+    out.flags.writeable = False
+    _frametimes_cache[key] = out
+    return out
+
+def read_frametimes(infile):
+    """ returns frametimes array (nframes, 4) sorted by frame,
+    see load_frametimes"""
+    return load_frametimes(infile).copy()
 
 
 
@@ -167,6 +414,10 @@ if __name__ == '__main__':
     allv  = glob('../test/*.v')
     ft_all = frametimes_from_ecats(allv)
     np.testing.assert_equal(ft_all[0,0],17.0)
+    # header reader matches nibabel
+    ft_nib = np.vstack([frametime_from_ecat(f) for f in allv])
+    ft_nib = ft_nib[ft_nib[:,0].argsort(),]
+    np.testing.assert_almost_equal(ft_all, ft_nib)
     # test naming
     outf = make_outfile(infile)
     np.testing.assert_equal('../test/frametimes' in outf, True)
@@ -191,8 +442,17 @@ if __name__ == '__main__':
     # roundtrip seconds
     ft = read_frametimes(outf_sec)
     np.testing.assert_almost_equal(ft[0,1], 540.016)
-    os.unlink(outf_sec)
-    os.unlink(outf)
+    # .npy record is memory mapped, matches the csv, read only
+    ft = load_frametimes(outf)
+    np.testing.assert_equal(ft, read_frametimes_csv(outf))
+    np.testing.assert_equal(ft.flags.writeable, False)
+    np.testing.assert_equal(ft.flags.owndata, False)
+    # unsorted records come back sorted by frame
+    save_frametimes(ft_all[::-1], frametimes_sidecar(outf))
+    np.testing.assert_equal(load_frametimes(outf), ft_all)
+    for item in [outf_sec, outf]:
+        os.unlink(item)
+        os.unlink(frametimes_sidecar(item))
 
     ## dicom
     inglob = '../../biograph_dicom/B12-219PIBFR1TO18/*'
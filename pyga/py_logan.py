@@ -11,21 +11,41 @@ import matplotlib.pyplot as plt
 import tempfile
 
  
+def ref_indices(refrois, shape):
+    """ loads each reference roi once and returns list of voxel
+    index tuples (np.nonzero) of voxels > 0 in each roi"""
+    if not is_iterable(refrois):
+        refrois = [refrois]
+    refidx = []
+    for refroi in refrois:
+        refdat = np.nan_to_num(ni.load(refroi).get_data().squeeze())
+        if not refdat.shape == tuple(shape):
+            raise IOError('%s has shape %s, not %s'%(refroi, refdat.shape,
+                                                    shape))
+        refidx.append(np.nonzero(refdat > 0))
+    return refidx
+
+def positive_mean(vals):
+    """mean over axis 0 of vals, only using values > 0"""
+    pos = vals > 0
+    return np.where(pos, vals, 0).sum(axis=0, dtype=np.float64) / pos.sum(axis=0)
+
+def get_refs(refrois, dat):
+    """given list of regions of interest, extracts mean of
+    each for every frame in dat, gathering each roi across all
+    frames at once
+    returns array (nrois, nframes)"""
+    refidx = ref_indices(refrois, dat.shape[:-1])
+    means = np.zeros((len(refidx), dat.shape[-1]))
+    for val, idx in enumerate(refidx):
+        means[val] = positive_mean(dat[idx])
+    return means
+
 def get_ref(refroi, dat):
     """given region of interest, extracts mean for each frame
     in dat, returns vector of means across time
     """
-    refdat = ni.load(refroi).get_data().squeeze()
-    if not refdat.shape == dat.shape[:-1]:
-        raise IOError('%s has shape %s, not %s'%(refroi, refdat.shape, dat.shape[1:]))
-    means = np.zeros(dat.shape[-1])
-    refdat = np.nan_to_num(refdat)
-    for val,slice in enumerate(dat.T):
-        ind = np.logical_and(slice > 0,
-                             refdat.T > 0)
-        means[val] = slice[ind].mean()
-    return means
-
+    return get_refs([refroi], dat)[0]
 
 def midframes_from_file(infile, units='sec'):
     """infile is a frametimes file each row has
@@ -36,22 +56,22 @@ def midframes_from_file(infile, units='sec'):
     midframes: vector of start-dur/2
     starttimes: vector of durations
     """
-    ft = np.loadtxt(infile, delimiter = ',',
-                    usecols = (1,2,3), skiprows = 1)
+    ft = frametimes_from_file(infile)
     midframes = ft[:,0] + ft[:,1] / 2
     return midframes, ft[:,1]
 
 def frametimes_from_file(infile):
     """infile is a frametimes file each row has
     [frame number, start dur, stop] in seconds
+    (parsed once per process, see frametimes.load_frametimes)
 
     Returns
     -------
     ft: array [start, duration, stop] in seconds for each frame
     """
-    ft = np.loadtxt(infile, delimiter = ',',
-                    usecols = (1,2,3), skiprows = 1)
-    return ft
+    import frametimes # needs pydicom, only import when used
+    ft = frametimes.load_frametimes(infile)
+    return ft[:,1:]
 
 def is_iterable(input):
     """checks if object can be iterated"""
@@ -77,6 +97,66 @@ def get_data_nibabel(infiles):
         print '4d files not supported yet'
         return None
 
+def iter_frames(infiles):
+    """ yields 3D frames one at a time, from a list of 3D frame files
+    or from a single 4D file
+    (nibabel memory maps uncompressed .nii, so only the voxels
+    indexed by the caller are read)
+    infiles may also be a NaN free view (preprocessing.CleanFrames)"""
+    if hasattr(infiles, 'files'):
+        for dat in infiles:
+            yield dat.reshape(dat.shape[:3])
+    elif is_iterable(infiles):
+        for f in infiles:
+            dat = ni.load(f).get_data()
+            yield dat.reshape(dat.shape[:3])
+    else:
+        dat = ni.load(infiles).get_data()
+        for i in np.arange(dat.shape[-1]):
+            yield dat[:,:,:,i]
+
+def n_frames(infiles):
+    """number of frames in a list of 3D files (or view) or a single 4D file"""
+    if hasattr(infiles, 'files') or is_iterable(infiles):
+        return len(infiles)
+    return ni.load(infiles).get_shape()[-1]
+
+def load_masked_frames(infiles, mask, dtype=np.float32, refrois=None):
+    """streams frames (list of 3D files, or a 4D file) one at a time
+    into a preallocated (nvox in mask, nframes) array, the 4D
+    volume is never loaded
+    same result as get_data_nibabel + mask_data, nan set to 0
+    and voxels must be nonzero in every frame
+    return masked_data and mask_bool
+
+    if refrois (list of reference roi files) is given, the reference
+    TACs are computed from the same frames as they are read, (as in
+    get_refs) and returned as a third array (nrois, nframes)"""
+    maskdat = ni.load(mask).get_data().squeeze()
+    inmask = maskdat > 0
+    nframes = n_frames(infiles)
+    new = np.empty((inmask.sum(), nframes), dtype=dtype)
+    if refrois is not None:
+        refidx = ref_indices(refrois, maskdat.shape)
+        refs = np.zeros((len(refidx), nframes))
+    for i, frame in enumerate(iter_frames(infiles)):
+        if not frame.shape == maskdat.shape:
+            raise IOError('shape mismatch, %s: %s and frame %d: %s'%(mask,
+                                                                    maskdat.shape,
+                                                                    i,
+                                                                    frame.shape))
+        new[:,i] = np.nan_to_num(frame[inmask])
+        if refrois is not None:
+            for val, idx in enumerate(refidx):
+                refs[val, i] = positive_mean(frame[idx])
+    # mask for both anatomical and PET data
+    data_mask = np.all(new != 0, axis=1)
+    fullmask = np.zeros(inmask.shape, dtype=bool)
+    fullmask[inmask] = data_mask
+    if refrois is not None:
+        return new[data_mask], fullmask, refs
+    return new[data_mask], fullmask
+
 def mask_data(mask, dat4d):
     """given a mask file and a 4d array
     mask data with data in maskfile
@@ -142,6 +222,7 @@ def save_inputplot(ref, midframes, outdir):
     basename = 'REF_TAC_%s'%(time.strftime('%Y-%m-%d-%H-%M'))
     figname = os.path.join(outdir, '%s.png'%(basename))
     plt.savefig(figname, format='png')  
+    plt.close(fig)
     return figname
   
 def save_data2nii(data, reference_img, filename='generic_file',outdir='.'):
@@ -166,19 +247,20 @@ def calc_xy(ref, masked_dat,midtimes, k2ref=.15):
     """calculates the x and y terms used in Logan Graphical Analysis
     y = integrated_data / data
     x = integrated_reference / data + (1 / k2ref) * reference / data
+    integrates along frames with the shared 1D time vector,
+    reference is integrated once and broadcast across voxels
     """
-    big_durs = repmat_1d(midtimes,masked_dat.shape[0])
-    int_dat = scipy.integrate.cumtrapz(masked_dat.T,big_durs.T,axis=0)
-    big_ref = repmat_1d(ref,masked_dat.shape[0])
-    int_ref = scipy.integrate.cumtrapz(big_ref.T,big_durs.T, axis=0)
-    y = (int_dat.T)  / masked_dat[:,1:]# 33, nvox in mask
-    x = (int_ref.T / masked_dat[:,1:]) + ( 1 / k2ref) *(big_ref[:,1:] / masked_dat[:,1:]) 
+    tail = masked_dat[:,1:]
+    int_dat = scipy.integrate.cumtrapz(masked_dat, midtimes, axis=1)
+    int_ref = scipy.integrate.cumtrapz(ref, midtimes)
+    y = int_dat
+    y /= tail # nvox in mask, 33
+    x = ref[1:] / tail
+    x *= ( 1 / k2ref)
+    x += int_ref / tail
     return x,y
 
 
-
-    
-
 def get_lstsq(x,y):
     """solves best fitting line using np.linalg.lstsq
     """
@@ -191,21 +273,50 @@ def get_lstsq(x,y):
     residues = results[1]
     return ki,vd,residues
 
-def calc_ki(x,y, timing_file, range=(35,90)):
-    """ calculates ki of data given reference, timing file,
-    and range of steady state data (in minutes)"""
-    
-    
+def fit_lines(x, y):
+    """ least squares line fit of every row of y against the same row
+    of x, solved in closed form for all rows at once
+
+    Parameters
+    ----------
+    x, y : arrays (nvox, npoints)
+
+    Returns
+    -------
+    slope, intercept, residues : arrays (nvox,)
+        residues is the sum of squared residuals,
+        rows where x or y are all zero (or x is constant) get 0
+    """
+    npoints = x.shape[-1]
+    xmean = x.mean(axis=-1)
+    ymean = y.mean(axis=-1)
+    xc = x - xmean[:, np.newaxis]
+    yc = y - ymean[:, np.newaxis]
+    sxx = (xc * xc).sum(axis=-1)
+    sxy = (xc * yc).sum(axis=-1)
+    valid = np.logical_and(np.any(x != 0, axis=-1), np.any(y != 0, axis=-1))
+    valid = np.logical_and(valid, sxx > 0)
+    slope = np.zeros(x.shape[0])
+    slope[valid] = sxy[valid] / sxx[valid]
+    intercept = np.where(valid, ymean - slope * xmean, 0.)
+    resid = yc - slope[:, np.newaxis] * xc
+    residues = np.where(valid, (resid * resid).sum(axis=-1), 0.)
+    return slope, intercept, residues
+
+def calc_ki_vd(x, y, timing_file, range=(35,90)):
+    """ calculates ki (DVR), vd (intercept) and residuals for every
+    voxel at once, given timing file and range of steady state
+    data (in minutes)"""
     ft = frametimes_from_file(timing_file)
-    
-    allki = np.zeros(x.shape[0])
-    resids = np.zeros(x.shape[0])
     start_end = np.logical_and(ft[1:,0] / 60. >= range[0],
                                ft[1:,2] / 60. <= range[1])
-    for val, (tmpx, tmpy) in enumerate(zip(x,y)):
-        ki,vd,residues = get_lstsq(tmpx[start_end],tmpy[start_end])
-        allki[val] = ki
-        resids[val] = residues
+    return fit_lines(x[:, start_end], y[:, start_end])
+
+def calc_ki(x,y, timing_file, range=(35,90)):
+    """ calculates ki of data given reference, timing file,
+    and range of steady state data (in minutes)
+    returns ki and residuals"""
+    allki, _, resids = calc_ki_vd(x, y, timing_file, range=range)
     return allki, resids
 
 def results_to_array(results, mask):
@@ -216,6 +327,63 @@ def results_to_array(results, mask):
     return dat
 
 if __name__ == '__main__':
+    import frametimes
+
+    # closed form fits against per voxel np.linalg.lstsq (get_lstsq)
+    rand = np.random.RandomState(0)
+    x = rand.uniform(1, 100, (50, 33))
+    y = 0.8 * x + 3 + rand.normal(0, 1, x.shape)
+    x[0] = 0 # voxel with no data
+    slope, intercept, residues = fit_lines(x, y)
+    for val, (tmpx, tmpy) in enumerate(zip(x, y)):
+        ki, vd, res = get_lstsq(tmpx, tmpy)
+        np.testing.assert_almost_equal(slope[val], ki)
+        np.testing.assert_almost_equal(intercept[val], vd)
+        np.testing.assert_almost_equal(residues[val], np.sum(res))
+
+    # calc_ki_vd only fits frames in the steady state range
+    durs = [15]*4 + [30]*8 + [60]*9 + [120]*4 + [300]*9
+    starts = np.concatenate([[0], np.cumsum(durs)[:-1]])
+    ftimes = np.array([[val + 1, start, dur, start + dur] for val,
+                       (start, dur) in enumerate(zip(starts, durs))])
+    tmp_timing = os.path.join(tempfile.mkdtemp(), 'frametimes.csv')
+    frametimes.write_frametimes(ftimes, tmp_timing)
+    allki, allvd, resids = calc_ki_vd(x, y, tmp_timing, range=(35,90))
+    steady = np.logical_and(ftimes[1:,1] / 60. >= 35,
+                            ftimes[1:,3] / 60. <= 90)
+    for val, (tmpx, tmpy) in enumerate(zip(x, y)):
+        ki, vd, res = get_lstsq(tmpx[steady], tmpy[steady])
+        np.testing.assert_almost_equal(allki[val], ki)
+        np.testing.assert_almost_equal(allvd[val], vd)
+        np.testing.assert_almost_equal(resids[val], np.sum(res))
+
+    # logan x, y against integrating each voxel on its own
+    midtimes = starts[1:] + np.asarray(durs[1:]) / 2.
+    ref = rand.uniform(1, 10, midtimes.shape[0])
+    dat = rand.uniform(1, 10, (20, midtimes.shape[0]))
+    x, y = calc_xy(ref, dat, midtimes, k2ref=0.15)
+    for val, row in enumerate(dat):
+        int_row = scipy.integrate.cumtrapz(row, midtimes)
+        int_ref = scipy.integrate.cumtrapz(ref, midtimes)
+        np.testing.assert_almost_equal(y[val], int_row / row[1:])
+        np.testing.assert_almost_equal(x[val], int_ref / row[1:] + \
+                                       (1 / 0.15) * (ref[1:] / row[1:]))
+
+    # reference TACs against masking every frame separately
+    dat4d = rand.uniform(-1, 10, (8, 9, 7, 5))
+    tmpdir = os.path.dirname(tmp_timing)
+    roifiles = []
+    for val in np.arange(2):
+        roi = (rand.uniform(0, 1, dat4d.shape[:-1]) > 0.5).astype(np.uint8)
+        roifiles.append(os.path.join(tmpdir, 'roi%d.nii'%val))
+        ni.Nifti1Image(roi, np.eye(4)).to_filename(roifiles[-1])
+    means = get_refs(roifiles, dat4d)
+    for val, roifile in enumerate(roifiles):
+        roi = ni.load(roifile).get_data()
+        for frame in np.arange(dat4d.shape[-1]):
+            tmp = dat4d[..., frame]
+            expected = tmp[np.logical_and(tmp > 0, roi > 0)].mean()
+            np.testing.assert_almost_equal(means[val, frame], expected)
 
     root = '/home/jagust/cindeem/CODE/GraphicalAnalysis/pyGA_refactor/test/pib2'
     k2ref = 0.15
@@ -226,11 +394,10 @@ if __name__ == '__main__':
     mask = '%s/rbrainmask.nii'%root
     timing_file = '%s/frametimes.csv'%root
     midtimes, durs = midframes_from_file(timing_file)
-    data4d = get_data_nibabel(frames)
-    
-    ref = get_ref(refroifile, data4d)
+    masked_data, mask_roi, refs = load_masked_frames(frames, mask,
+                                                     refrois=[refroifile])
+    ref = refs[0]
     ref_fig = save_inputplot(ref, (midtimes + durs/2.), root)
-    masked_data, mask_roi = mask_data(mask, data4d)
     x,y  = calc_xy(ref,masked_data, midtimes)
     allki, residuals = calc_ki(x, y, timing_file, range=range)
     dvr = results_to_array(allki, mask_roi)
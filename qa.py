@@ -42,18 +42,32 @@ def plot_movement(infile, subid):
 
 
 def make_4d_nibabel(infiles,outdir=None):
-    shape = ni.load(infiles[0]).get_shape()
+    """ stacks frames into a 4D file (nan set to 0), infiles is a
+    list of 3D files or a NaN free view (preprocessing.CleanFrames)"""
+    prefix = 'data4d_'
+    if hasattr(infiles, 'files'):
+        # already NaN free, frames loaded lazily, named as the
+        # 4D file of the nonan- copies (see preprocessing.clean_nan)
+        frames = infiles
+        infiles = frames.files
+        prefix = 'data4d_nonan-'
+    else:
+        frames = None
+    img = ni.load(infiles[0])
+    shape = img.get_shape()
     finalshape = tuple([x for x in shape]+[len(infiles)])
     dat4d = np.empty(finalshape)
     for val, f in enumerate(infiles):
-        tmpdat = ni.load(f).get_data()
-        tmpdat[np.isnan(tmpdat)] =  0
+        if frames is None:
+            tmpdat = np.nan_to_num(ni.load(f).get_data())
+        else:
+            tmpdat = frames[val]
         dat4d[:,:,:,val] = tmpdat
-    newimg = ni.Nifti1Image(dat4d, ni.load(infiles[0]).get_affine())
+    newimg = ni.Nifti1Image(dat4d, img.get_affine())
     if outdir is None:
-        outf = fname_presuffix(infiles[0], prefix='data4d_')
+        outf = fname_presuffix(infiles[0], prefix=prefix)
     else:
-        outf = fname_presuffix(infiles[0], prefix='data4d_',newpath = outdir)
+        outf = fname_presuffix(infiles[0], prefix=prefix,newpath = outdir)
     newimg.to_filename(outf)
     return outf
 